@@ -21,6 +21,14 @@
 
 import gdb
 import re
+from functools import lru_cache
+from bisect import bisect_right
+import hashlib
+import itertools
+import json
+from collections import OrderedDict
+from gdb.FrameDecorator import FrameDecorator
+from gdb.FrameIterator import FrameIterator
 # Python 2/3 way to get "imap", suggested by SO
 try:
     from itertools import imap
@@ -28,6 +36,189 @@ except ImportError:
     # Python3
     imap = map
 
+# Common type aliases, as (regex, replacement, required text) rules applied in order.
+# (Anything with a regex's sub() method can stand in for the regex.)
+# Later rules see the output of earlier ones, so e.g. a vector of std::__cxx11::basic_string
+# is first rewritten to a vector of std::string and then to std::vector<std::string >.
+# A rule is only tried on names containing its required text (if any), which lets
+# most names skip the regex engine entirely. Users can add rules with add_alias().
+
+# __gnu_cxx::__normal_iterator<T*, std::vector<T > > becomes std::vector<T >::iterator.
+# T can be any type, nested as deeply as you like, and ".*" with a backreference can
+# backtrack across the whole of a long demangled name, so instead of a regex we find
+# the iterator's arguments by matching brackets and compare the text directly.
+# This has the same sub() method as a compiled regex, so it can go in the table.
+class _VectorIteratorAlias:
+    prefix = '__gnu_cxx::__normal_iterator<'
+
+    @staticmethod
+    def _split_args(name, start):
+        """Return the top-level template arguments beginning at start, and the index of the closing >"""
+        args = []
+        depth = 0
+        arg_start = start
+        for idx in range(start, len(name)):
+            c = name[idx]
+            if c == '<':
+                depth += 1
+            elif c == '>':
+                if depth == 0:
+                    args.append(name[arg_start:idx])
+                    return args, idx
+                depth -= 1
+            elif c == ',' and depth == 0:
+                args.append(name[arg_start:idx])
+                arg_start = idx + 2 if name.startswith(', ', idx) else idx + 1
+        return None, None    # unbalanced
+
+    def sub(self, repl, name):
+        out = []
+        pos = 0
+        while True:
+            idx = name.find(self.prefix, pos)
+            if idx < 0:
+                break
+            args, close = self._split_args(name, idx + len(self.prefix))
+            if args is None:
+                break
+            if len(args) == 2 and args[0].endswith('*'):
+                elt = args[0][:-1]
+                if args[1] in ('std::vector<%s > '%elt,
+                               'std::vector<%s, std::allocator<%s > > '%(elt, elt)):
+                    out.append(name[pos:idx])
+                    out.append('std::vector<%s >::iterator'%self.sub(repl, elt))
+                    pos = close + 1
+                    continue
+            # not a vector iterator; there may be one among its arguments
+            end = idx + len(self.prefix)
+            out.append(name[pos:end])
+            pos = end
+        out.append(name[pos:])
+        return ''.join(out)
+
+alias_rules = [
+    # rename std::string
+    (re.compile(re.escape('std::__cxx11::basic_string<char>')), 'std::string', 'basic_string<'),
+    (re.compile(re.escape('std::__cxx11::basic_string<char, std::char_traits<char>, std::allocator<char> >')), 'std::string', 'basic_string<'),
+    # turn std::vector<T, std::allocator<T>> into std::vector<T>
+    (re.compile(r"std::vector<([^<>]*), std::allocator<\1 > >"), r"std::vector<\1 >", 'std::allocator<'),
+    # turn __gnu_cxx::__normal_iterator<T*, std::vector<T > > into std::vector<T>::iterator
+    (_VectorIteratorAlias(), None, '__normal_iterator<'),
+]
+
+def add_alias(pattern, replacement, required = None):
+    """Add a rewrite rule for function names in backtraces
+
+    pattern may be a string or a compiled regex, and replacement is as for re.sub.
+    If required is given, the rule is only tried on names containing that text.
+    Rules are applied in the order they were added.
+    """
+    if isinstance(pattern, str):
+        pattern = re.compile(pattern)
+    alias_rules.append((pattern, replacement, required))
+    rewrite_name.cache_clear()   # earlier results may no longer be right
+
+# Deep recursion means the same names over and over, so remember our results
+@lru_cache(maxsize=4096)
+def rewrite_name(name):
+    """Apply the alias rules to a function name"""
+    if name is None or name.startswith("<lambda"):
+        # this starts with an angle bracket but won't have any template parameters
+        return name
+    for prog, repl, required in alias_rules:
+        if required is None or required in name:
+            name = prog.sub(repl, name)
+    return name
+
+# Looking up the symbol for a frame is the expensive part of filtering it, and
+# deep (especially runaway recursive) stacks visit the same few functions over and
+# over. So we remember names by code address, and remember the address range of
+# each function's code so other addresses inside it don't need a lookup either.
+class FunctionNameCache:
+    """Function names by code address"""
+
+    def __init__(self, maxsize = 65536):
+        self.maxsize = maxsize
+        self._by_pc = {}
+        self._starts = []      # sorted start addresses of known function ranges
+        self._ranges = []      # (end, name) for each entry of _starts
+        gdb.events.new_objfile.connect(self._onObjfilesChanged)
+        gdb.events.clear_objfiles.connect(self._onObjfilesChanged)
+
+    def clear(self):
+        self._by_pc.clear()
+        self._starts = []
+        self._ranges = []
+
+    def name(self, frame):
+        """Return the function name for a gdb.Frame, or None if it is unknown"""
+
+        if frame.type() == gdb.INLINE_FRAME:
+            # an inlined function shares its addresses with its caller
+            return frame.name()
+
+        pc = frame.pc()
+        if pc in self._by_pc:
+            return self._by_pc[pc]
+
+        # is it inside a function we already know?
+        idx = bisect_right(self._starts, pc) - 1
+        if idx >= 0 and pc < self._ranges[idx][0]:
+            name = self._ranges[idx][1]
+        else:
+            name = frame.name()
+            # find the block for the whole function, not just some inlined part of it
+            block = gdb.block_for_pc(pc)
+            while block is not None and (block.function is None or
+                                         (block.superblock is not None and block.superblock.function is not None)):
+                block = block.superblock
+            if block is not None and name is not None and _contiguous(block):
+                self._addRange(block.start, block.end, name)
+
+        if len(self._by_pc) >= self.maxsize:
+            self._by_pc.clear()
+        self._by_pc[pc] = name
+        return name
+
+    def _addRange(self, start, end, name):
+        if len(self._starts) >= self.maxsize:
+            self._starts = []
+            self._ranges = []
+        idx = bisect_right(self._starts, start)
+        self._starts.insert(idx, start)
+        self._ranges.insert(idx, (end, name))
+
+    def _onObjfilesChanged(self, event):
+        # code may have been loaded at addresses we already know
+        self.clear()
+
+# A function's block runs from the lowest to the highest address of any of its parts.
+# If the function is split (e.g. GCC moving unlikely code to a separate "foo.cold"),
+# other functions may lie in between, so the range is only usable for a function
+# whose code is all in one piece: it starts at its entry point, and the linker
+# symbol covering its last byte is its own.
+_msym_re = re.compile(r'<(.*?)(?:\+[0-9]+)?>$')
+
+def _linker_symbol(addr):
+    m = _msym_re.search(gdb.format_address(addr))
+    return m.group(1) if m else None
+
+def _contiguous(block):
+    try:
+        entry = getattr(block, 'entry_pc', None)     # gdb 16+
+        if entry is None:
+            entry = int(block.function.value().address)
+    except gdb.error:
+        return False
+    if entry != block.start:
+        return False
+    if hasattr(gdb, 'format_address'):              # gdb 13+
+        sym = _linker_symbol(block.start)
+        return sym is not None and _linker_symbol(block.end - 1) == sym
+    return True
+
+function_names = FunctionNameCache()
+
 # define a stack frame decorator to make them less verbose
 class CommonAliasDecorator(gdb.FrameDecorator.FrameDecorator):
     def __init__(self, fobj):
@@ -35,26 +226,19 @@ class CommonAliasDecorator(gdb.FrameDecorator.FrameDecorator):
 
     # rewrite the function name to make it a bit less ugly:
     def function(self):
-        name = self.inferior_frame().name()
-        if name.startswith("<lambda"):
-            # this starts with an angle bracket but won't have any template parameters
-            return name
-        # rename std::string
-        orig = name
-        name = re.sub('std::__cxx11::basic_string<char>', 'std::string', name)
-        name = re.sub('std::__cxx11::basic_string<char, std::char_traits<char>, std::allocator<char> >', 'std::string', name)
-        # turn std::vector<T, std::allocator<T>> into std::vector<T>
-        name = re.sub(r"std::vector<([^<>]*), std::allocator<\1 > >", r"std::vector<\1 >", name)
-        # turn __gnu_cxx::__normal_iterator<T*, std::vector<T > > into std::vector<T>::iterator
-        name = re.sub(r"__gnu_cxx::__normal_iterator<(.*)\*, std::vector<\1 > >", r"std::vector<\1 >::iterator", name)
-        name = re.sub(r"__gnu_cxx::__normal_iterator<(.*)\*, std::vector<\1, std::allocator<\1 > > >", r"std::vector<\1 >::iterator", name)
-
-        return name
+        name = function_names.name(self.inferior_frame())
+        if name is None:
+            return self.inferior_frame().pc()    # as FrameDecorator does
+        return rewrite_name(name)
 
 # define a stack frame filter
 class UserFilter:
     """Filter library functions out of stack trace"""
 
+    # class globals, maintained by the backtrace-strip-regex(es) parameters
+    stripProg = None      # compiled backtrace-strip-regex
+    groupProg = None      # compiled backtrace-strip-regexes
+
     def __init__(self):
         # set required attributes
         self.name = 'UserFilter'
@@ -65,6 +249,56 @@ class UserFilter:
         # (manual suggests avoiding global filter list; this seems appropriate)
         gdb.current_progspace().frame_filters[self.name] = self
 
+    @staticmethod
+    def setRegexes(strip_regex, strip_regexes):
+        """Compile new squash regexes, forgetting any classifications made with the old ones"""
+        try:
+            UserFilter.stripProg = re.compile(strip_regex) if strip_regex else None
+            UserFilter.groupProg = re.compile(strip_regexes) if strip_regexes else None
+        except re.error as e:
+            raise gdb.GdbError('invalid regex: %s'%e)
+        UserFilter._classify.cache_clear()
+
+    @staticmethod
+    def _squashProg():
+        """Return the regex in effect and whether to squash by capture group"""
+        # backtrace-strip-regexes overrides backtrace-strip-regex
+        if UserFilter.groupProg is not None:
+            # if there are no (or one) capture groups, treat this like backtrace-strip-regex
+            return UserFilter.groupProg, UserFilter.groupProg.groups >= 2
+        return UserFilter.stripProg, False
+
+    # The same library functions show up again and again in backtraces (especially
+    # in deep recursion) so we remember how each name was classified.
+    @staticmethod
+    @lru_cache(maxsize=8192)
+    def _classify(name):
+        """Return the squash key for a function name: None if it does not match,
+        otherwise the number of the first capture group matched (or 0 when not
+        grouping)"""
+        prog, grouped = UserFilter._squashProg()
+        m = prog.match(name)
+        if not m:
+            return None
+        if not grouped:
+            return 0
+        # "groups" will give us a tuple of all the capture groups
+        # and None if the particular group did not match
+        for idx, grp in enumerate(m.groups()):
+            if grp is not None:
+                return idx + 1
+        return None   # no capture group matched
+
+    @staticmethod
+    def _squashKey(frame):
+        # going straight to the frame's (cached) name is much cheaper than
+        # FrameDecorator.function(), which looks up the symbol every time
+        name = function_names.name(frame.inferior_frame())
+        if name is None:
+            # we don't know the function name for this frame
+            return None
+        return UserFilter._classify(name)
+
     @staticmethod
     def __cond_squash(iterable, squashfn):
         """wrap iterator to compress subsequences for which a predicate is true, keeping only the *last* of each"""
@@ -81,82 +315,44 @@ class UserFilter:
             yield last           # in case we end in "squashed" mode
 
     @staticmethod
-    def __adjacent_squash(iterable, squashfn):
-        """wrap iterator to compress subsequences with a binary predicate
+    def __adjacent_squash(iterable, keyfn):
+        """wrap iterator to compress subsequences with equal keys
 
         This adapter will drop all but the last of any sequence for which
-        squashfn(prev, current) is true
+        keyfn gives the same result. A key of None never matches.
         """
 
         last = None
+        last_key = None
         for item in iterable:
-            if last is None:
-                last = item
-            else:
-                if squashfn(last, item):
-                    # discard previous
-                    last = item
-                else:
-                    yield last
-                    last = item
+            key = keyfn(item)
+            if last is not None and (key is None or key != last_key):
+                yield last
+            # otherwise discard previous
+            last = item
+            last_key = key
         if last is not None:
             yield last
 
-    @staticmethod
-    def __same_cgroup(prog, a, b):
-        """return true if a and b match the same capture group of prog"""
-
-        if (a.function() == a.address()) or (b.function() == b.address()):
-            # we don't know the function name for at least one of the frames
-            return False
-        if not prog.match(str(a.function())) or not prog.match(str(b.function())):
-            # at least one doesn't match at all
-            return False
-        a_match = prog.match(a.function())
-        b_match = prog.match(b.function())
-        if a_match.lastindex is None or b_match.lastindex is None:
-            # no capture group matched in one or both
-            return False
-        # figure out if there are any matching capture groups
-        # "groups" will give us a tuple of all the capture groups
-        # and None if the particular group did not match
-        for a, b in zip(a_match.groups(), b_match.groups()):
-            if a is not None and b is not None:
-                return True
-
-        return False
-
 
     def filter(self, frame_iter):
-        # first check for multi-regex option
-        squash_regexes = gdb.parameter('backtrace-strip-regexes')
-        # If present we compress stack frames with matching capture groups
-        if squash_regexes:
-            prog = re.compile(squash_regexes)
-            # if there are no (or one) capture groups, treat this like squash_regex
-            if prog.groups < 2:
-                squash_regex = squash_regexes
-            else:
-                # wrap the current iterator in a squash-matching-subsequences iterator
-                # with the predicate "function name matches same regex"
-                ufi = UserFilter.__adjacent_squash(frame_iter,
-                                                   lambda a, b : UserFilter.__same_cgroup(prog, a, b))
-                # further wrap in a decorator and return
-                return imap(CommonAliasDecorator, ufi)
+        prog, grouped = UserFilter._squashProg()
+        if prog is None:
+            # just add the decorator to the original iterator
+            return imap(CommonAliasDecorator, frame_iter)
+
+        if grouped:
+            # If present we compress stack frames with matching capture groups
+            # wrap the current iterator in a squash-matching-subsequences iterator
+            ufi = UserFilter.__adjacent_squash(frame_iter, UserFilter._squashKey)
         else:
             # single regex is simpler - we compress based on match/nomatch
-            squash_regex = gdb.parameter('backtrace-strip-regex')
-
-        if squash_regex:
             ufi = UserFilter.__cond_squash(frame_iter,
-                                           lambda x : ((x.function() != x.address()) and
-                                                       re.match(squash_regex, x.function())))
-            return imap(CommonAliasDecorator, ufi)
-        else:
-            # just add the decorator to the original iterator
-            return imap(CommonAliasDecorator, frame_iter)
+                                           lambda x : UserFilter._squashKey(x) is not None)
+        # further wrap in a decorator and return
+        return imap(CommonAliasDecorator, ufi)
 
-UserFilter()
+user_filter = UserFilter()
 
 # Allow users to specify regex used in stepping
 class BacktraceStripRegex (gdb.Parameter):
@@ -170,9 +366,11 @@ class BacktraceStripRegex (gdb.Parameter):
                                                     gdb.COMMAND_STACK,
                                                     gdb.PARAM_STRING_NOESCAPE)
         self.value = '^(std::|__gnu)'   # default
+        UserFilter.setRegexes(self.value, UserFilter.groupProg and UserFilter.groupProg.pattern)
 
     # required API
     def get_set_string(self):
+        UserFilter.setRegexes(self.value, UserFilter.groupProg and UserFilter.groupProg.pattern)
         return self.value
 
     def get_show_string(self, svalue):
@@ -207,9 +405,151 @@ class BacktraceStripRegexes (gdb.Parameter):
 
     # required API
     def get_set_string(self):
+        UserFilter.setRegexes(UserFilter.stripProg and UserFilter.stripProg.pattern, self.value)
         return self.value
 
     def get_show_string(self, svalue):
         return self.value
 
 BacktraceStripRegexes()
+
+# Gathering filtered backtraces from all threads, for analysis by other tools
+
+def _threadStacks():
+    """Generate (thread, filtered frames) for each thread of the current inferior
+
+    The selected thread and frame are restored afterwards.
+    """
+    orig_thread = gdb.selected_thread()
+    orig_frame = gdb.selected_frame()
+    try:
+        for thread in sorted(gdb.selected_inferior().threads(), key=lambda t: t.num):
+            thread.switch()
+            frames = imap(FrameDecorator, FrameIterator(gdb.newest_frame()))
+            yield thread, user_filter.filter(frames)
+    finally:
+        orig_thread.switch()
+        orig_frame.select()
+
+def _frameRecord(frame):
+    """Return (pc, function, file, line) for a decorated frame"""
+    name = frame.function()
+    if not isinstance(name, str):
+        name = None    # no symbol; the decorator gave us the pc instead
+    return (frame.address(), name, frame.filename(), frame.line())
+
+def _jsonLine(obj):
+    return json.dumps(obj, separators=(',', ':')) + '\n'
+
+class BacktraceExport (gdb.Command):
+    """Write filtered backtraces of all threads to FILE as JSON Lines
+
+    Usage: bt-export FILE
+
+    Frames are filtered and renamed just as for "backtrace". Each distinct stack
+    is written once, as {"stack": ID, "frames": [[INDEX, PC, FUNCTION, FILE, LINE], ...]},
+    followed by {"thread": NUM, "name": NAME, "stack": ID} for each thread, and at
+    the end {"stack": ID, "count": N} for the number of threads with each stack.
+    """
+
+    def __init__ (self):
+        super (BacktraceExport, self).__init__ ("bt-export", gdb.COMMAND_STACK, gdb.COMPLETE_FILENAME)
+
+    def invoke (self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 1:
+            raise gdb.GdbError('usage: bt-export FILE')
+
+        stack_ids = {}    # digest of stack contents -> stack id
+        counts = []       # thread count by stack id
+        try:
+            with open(argv[0], 'w') as out:
+                for thread, frames in _threadStacks():
+                    # only one stack at a time is held in memory
+                    stack = [_frameRecord(f) for f in frames]
+                    digest = hashlib.sha1(repr(stack).encode('utf-8')).digest()
+                    stack_id = stack_ids.get(digest)
+                    if stack_id is None:
+                        stack_id = len(counts)
+                        stack_ids[digest] = stack_id
+                        counts.append(0)
+                        out.write(_jsonLine({'stack': stack_id,
+                                             'frames': [(idx,) + rec for idx, rec in enumerate(stack)]}))
+                    counts[stack_id] += 1
+                    out.write(_jsonLine({'thread': thread.num, 'name': thread.name, 'stack': stack_id}))
+                for stack_id, count in enumerate(counts):
+                    out.write(_jsonLine({'stack': stack_id, 'count': count}))
+        except gdb.error:
+            print("gdb got an error. Maybe we are not currently running?")
+            return
+        print('%d threads with %d distinct stacks written to %s'%(sum(counts), len(counts), argv[0]))
+
+BacktraceExport()
+
+# Summarize many threads by grouping those with the same (filtered) stack
+class BacktraceCluster (gdb.Command):
+    """Group threads by the function names in their filtered backtraces
+
+    Usage: bt-cluster [DEPTH]
+
+    Frames are filtered and renamed just as for "backtrace". Threads whose stacks
+    have the same sequence of function names share a signature; each signature is
+    shown with its thread count and the backtrace of one of its threads, most
+    common first. If DEPTH is given only the innermost DEPTH frames are compared,
+    and frames beyond that are never unwound; otherwise every thread's stack is
+    unwound completely.
+    """
+
+    def __init__ (self):
+        super (BacktraceCluster, self).__init__ ("bt-cluster", gdb.COMMAND_STACK)
+
+    @staticmethod
+    def _signature(frames, depth):
+        """Hash the function names of frames, returning the digest and the frames used"""
+        h = hashlib.sha1()
+        records = []
+        # Hash as we go, so frames beyond depth are never unwound. Without a depth the
+        # whole stack is unwound: two threads can differ in their outermost frames,
+        # so a shared prefix doesn't tell us anything until we reach the end.
+        for frame in itertools.islice(frames, depth):
+            rec = _frameRecord(frame)
+            # unknown functions are identified by address instead
+            h.update((rec[1] if rec[1] is not None else '0x%x'%rec[0]).encode('utf-8'))
+            h.update(b'\n')
+            records.append(rec)
+        return h.hexdigest()[:12], records
+
+    def invoke (self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        depth = None
+        if len(argv) > 1:
+            raise gdb.GdbError('usage: bt-cluster [DEPTH]')
+        if argv:
+            try:
+                depth = int(argv[0])
+            except ValueError:
+                raise gdb.GdbError('bt-cluster: DEPTH must be a number')
+
+        clusters = OrderedDict()   # signature -> (thread numbers, representative frames)
+        try:
+            for thread, frames in _threadStacks():
+                sig, records = BacktraceCluster._signature(frames, depth)
+                if sig not in clusters:
+                    clusters[sig] = ([], records)
+                clusters[sig][0].append(thread.num)
+        except gdb.error:
+            print("gdb got an error. Maybe we are not currently running?")
+            return
+
+        out = []
+        for sig, (threads, records) in sorted(clusters.items(), key=lambda c: -len(c[1][0])):
+            out.append('%d threads in signature %s (threads %s)'%(len(threads), sig,
+                                                                  ', '.join(str(t) for t in threads)))
+            for idx, (pc, name, fname, line) in enumerate(records):
+                if fname is not None and line is not None:
+                    out.append('  #%-3d 0x%016x in %s at %s:%d'%(idx, pc, name or '??', fname, line))
+                else:
+                    out.append('  #%-3d 0x%016x in %s'%(idx, pc, name or '??'))
+        print('\n'.join(out))
+
+BacktraceCluster()
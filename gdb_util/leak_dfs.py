@@ -19,31 +19,48 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from graph_tool import Graph
-from graph_tool.search import DFSVisitor, dfs_search
+import os
+from collections import defaultdict
+
+# graph_tool takes a long time to import, and is often not installed, so by default
+# we use our own small graph. Set GDB_UTIL_GRAPH=graph_tool in the environment
+# before loading this module to use graph_tool instead.
+if os.environ.get('GDB_UTIL_GRAPH') == 'graph_tool':
+    from graph_tool import Graph
+    from graph_tool.search import DFSVisitor, StopSearch, dfs_search
+    from graph_tool.topology import label_components
+else:
+    from gdb_util.ptrgraph import Graph, DFSVisitor, StopSearch, dfs_search, label_components
 
 class PointerGraph(Graph):
     """wrapper for the graph of memory block pointers"""
-    def __init__(self, start):
+    def __init__(self, start = None, trace = None):
         super(PointerGraph, self).__init__()
-        # the block base address (as a string) for each vertex
-        self.vaddr_pmap = self.new_vertex_property('string')
+        # the block base address for each vertex
+        self.vaddr_pmap = self.new_vertex_property('int64_t')
+        # the allocation backtrace for each vertex, as an index into a vgparse.TraceTable
+        # (-1 if we don't have one)
+        self.backtraces = self.new_vertex_property('int64_t')
         self.addr2v = {}
-        self.root = self.create_ptr(start)
+        # vertices whose neighbors have been added; the graph may be searched more than once
+        self.expanded = self.new_vertex_property('bool')
+        # the starting point of our search, if we have one
+        self.root = self.create_ptr(start, trace) if start is not None else None
 
     # create just the vertex representing a particular pointer
-    def create_ptr(self, addr):
+    def create_ptr(self, addr, trace = None):
         v = self.add_vertex()
         self.addr2v[addr] = v
         self.vaddr_pmap[v] = addr
+        self.backtraces[v] = trace if trace is not None else -1
         return v
 
     # create a new vertex for a pointer to an existing block
     # notice our edges go in the opposite "direction" of a pointer
     # edges are from pointee to point-er, or from the block being
     # referenced, to the block that is doing the referencing
-    def create_ptr_edge(self, addr, u):
-        v = self.create_ptr(addr)   # the referencer
+    def create_ptr_edge(self, addr, u, trace = None):
+        v = self.create_ptr(addr, trace)   # the referencer
         return self.add_edge(u, v)
 
 class LoopFindVisitor(DFSVisitor):
@@ -56,8 +73,10 @@ class LoopFindVisitor(DFSVisitor):
 
     def discover_vertex(self, u):
         # having arrived here for the first time, we need to add any out edges
-        # add bogus additional vertex and edge
-        self.expand_vertex(self.g, u)
+        # (unless an earlier search already did)
+        if not self.g.expanded[u]:
+            self.g.expanded[u] = True
+            self.expand_vertex(self.g, u)
 
     def tree_edge(self, e):
         # this is where we update the predecessor map
@@ -69,3 +88,17 @@ class LoopFindVisitor(DFSVisitor):
         # for now I'm only interested in loops that go back to the root
         if e.target() == self.g.root:
             self.backedge_action(self.g, e, self.pred)
+
+# Find every pointer cycle at once, rather than searching from a particular block
+def cycle_groups(g):
+    """Return the vertices of each strongly connected component containing a cycle
+
+    Each group is a list of vertex indices. Every block in a group can reach
+    every other by following pointers.
+    """
+    comp, hist = label_components(g, directed=True)
+    groups = defaultdict(list)
+    for v in g.vertices():
+        groups[int(comp[v])].append(int(v))
+    # single blocks can't form a cycle, as we don't record pointers from a block to itself
+    return [vs for c, vs in groups.items() if hist[c] > 1]
@@ -21,88 +21,390 @@
 
 from clang import cindex
 from os import path
+import os
+import hashlib
+import threading
+import queue
+from functools import wraps
 
 # CompilationDatabase.getCompileCommands() will try to "infer" build commands
 # for files that are not present in the compilation database - including headers,
 # surprisingly. See https://bugs.llvm.org/show_bug.cgi?id=50249
-# We don't want this, so here's our alternative implementation:
+# We don't want this, so here's our alternative implementation.
+# Compilation databases can be large, so we load each one once, index it by
+# normalized source path, and only reload it when the JSON file changes.
 
-def _getCompileCommands(compdb, fname):
-    """Return a list of commands to build fname. If fname is not found in compdb, return None"""
+_compdb_cache = {}     # normalized compdb_fname -> _CompDBIndex
+_compdb_lock = threading.Lock()
 
-    all_cmds = compdb.getAllCompileCommands()
-    cmds = [cmd for cmd in all_cmds if cmd.filename == path.abspath(fname)]
-    return cmds if len(cmds) > 0 else None
+def _mtime(fname):
+    try:
+        return os.stat(fname).st_mtime
+    except OSError:
+        return None   # deleted files are "changed" files
+
+def _normpath(fname, directory=None):
+    if directory is not None:
+        fname = path.join(directory, fname)
+    return path.normpath(path.abspath(fname))
+
+class _CompDBIndex:
+    """A compilation database with its commands indexed by source file"""
+
+    def __init__(self, compdb_fname):
+        compilation_database_path = path.dirname(compdb_fname)
+        try:
+            compdb = cindex.CompilationDatabase.fromDirectory(compilation_database_path)
+        except cindex.CompilationDatabaseError:
+            raise RuntimeError('Could not load compilation database for %s'%compilation_database_path)
+        self.mtime = _mtime(compdb_fname)
+        self.commands = {}
+        for cmd in compdb.getAllCompileCommands():
+            self.commands.setdefault(_normpath(cmd.filename, cmd.directory), []).append(cmd)
+        self._args = {}   # normalized fname -> filtered compiler arguments
+
+    def getCompileCommands(self, fname):
+        """Return a list of commands to build fname. If fname is not found, return None"""
+        return self.commands.get(_normpath(fname))
+
+    def getCompileArgs(self, fname):
+        """Return the arguments libclang needs to parse fname, or None if it is not found"""
+
+        key = _normpath(fname)
+        if key in self._args:
+            return self._args[key]
+        cmds = self.commands.get(key)
+        if cmds is None:
+            return None
+
+        # assuming only one command is required to build
+        cmd = cmds[0]
+
+        # filter irrelevant command line components
+        args = []
+        arg_gen = cmd.arguments
+        next(arg_gen)            # remove compiler executable path
+        for arg in arg_gen:
+            if arg == '-c':
+                # if we don't drop the -c input filename we get a TU parse error...
+                next(arg_gen)    # drop input filename
+            elif arg == '-o':
+                next(arg_gen)    # drop output filename
+            else:
+                args.append(arg)
+
+        self._args[key] = args
+        return args
+
+def getCompilationDatabase(compdb_fname = './compile_commands.json'):
+    """Return the indexed compilation database, (re)loading it if it has changed on disk"""
+
+    key = _normpath(compdb_fname)
+    with _compdb_lock:
+        compdb = _compdb_cache.get(key)
+        if compdb is None or compdb.mtime != _mtime(compdb_fname):
+            compdb = _CompDBIndex(compdb_fname)
+            _compdb_cache[key] = compdb
+    return compdb
+
+# Parsing a translation unit is by far the most expensive thing we do, and stepu
+# does it every time it is invoked. Keep the parsed TUs around, keyed by the file
+# and the arguments used to build it, and throw them out when any of the files
+# that went into them change.
+# libclang does not allow a translation unit (or its index) to be used from more
+# than one thread at a time, so all parsing goes through parse_lock.
+
+parse_lock = threading.RLock()
+_index = None          # one libclang Index serves all our translation units
+_tu_cache = {}         # (tu_fname, args) -> _CachedTU
+ast_cache_dir = None   # if set, a directory for saving parsed TUs between sessions
+
+def _synchronized(fn):
+    @wraps(fn)
+    def locked(*args, **kwargs):
+        with parse_lock:
+            return fn(*args, **kwargs)
+    return locked
+
+def _getIndex():
+    global _index
+    if _index is None:
+        _index = cindex.Index.create()
+    return _index
+
+class _CachedTU:
+    """A parsed translation unit plus the modification times of everything it read"""
+
+    def __init__(self, translation_unit, from_ast=False):
+        self.translation_unit = translation_unit
+        self.from_ast = from_ast   # loaded from a saved AST, not parsed from source
+        self.memo = {}    # results computed from this parse
+        self._record_mtimes()
+
+    def _record_mtimes(self):
+        tu = self.translation_unit
+        self.mtimes = {_normpath(tu.spelling): _mtime(tu.spelling)}
+        for inc in tu.get_includes():
+            fname = _normpath(inc.include.name)
+            if fname not in self.mtimes:
+                self.mtimes[fname] = _mtime(fname)
+
+    def stale(self):
+        """True if any of the files this TU was parsed from has been modified"""
+        return any(_mtime(fname) != mtime for fname, mtime in self.mtimes.items())
+
+    def newer_than(self, t):
+        """True if any of the files this TU was parsed from was modified after time t"""
+        return any(mtime is None or mtime > t for mtime in self.mtimes.values())
+
+    def depends_on(self, fname):
+        return _normpath(fname) in self.mtimes
+
+    def reparse(self):
+        """Reparse in place, returning False if that could not be done
+
+        A TU loaded from a saved AST has no compiler invocation to rerun, and after
+        a failed reparse libclang only allows the TU to be disposed of. Either way
+        the entry must be dropped and the source parsed afresh.
+        """
+        if self.from_ast:
+            return False
+        self.memo.clear()   # cursors from the old parse are no longer valid
+        # TranslationUnit.reparse() ignores the result, so we make the call ourselves
+        if cindex.conf.lib.clang_reparseTranslationUnit(self.translation_unit, 0, None, 0) != 0:
+            return False
+        self._record_mtimes()
+        return True
+
+def _checkDiagnostics(translation_unit, verbose=True):
+    if (len(translation_unit.diagnostics) > 0):
+        if verbose:
+            print(['%s:%s'%(x.category_name, x.spelling) for x in translation_unit.diagnostics])
+        raise RuntimeError('Failure during libclang parsing')
 
+def _astFileName(tu_fname, args):
+    key = '\0'.join((tu_fname,) + args).encode('utf-8')
+    return path.join(ast_cache_dir, '%s-%s.ast'%(path.basename(tu_fname), hashlib.sha1(key).hexdigest()))
 
-def getASTNode(fname, line, column, tu_fname = None, compdb_fname = './compile_commands.json'):
-    """Find the enclosing AST node of a given location
+def _loadSavedTU(tu_fname, args):
+    """Load a previously saved parse of this TU, if present and up to date"""
 
-    Keyword arguments:
-    fname        -- the file containing the desired node
-    line         -- the line of the node
-    column       -- the column of the node
-    tu_fname     -- the source file containing the compiled translation unit, if different (i.e. if fname was included)
-    compdb_fname -- the file containing the compilation database
+    ast_fname = _astFileName(tu_fname, args)
+    saved_time = _mtime(ast_fname)
+    if saved_time is None:
+        return None
+    try:
+        entry = _CachedTU(cindex.TranslationUnit.from_ast_file(ast_fname, _getIndex()), from_ast=True)
+    except cindex.TranslationUnitLoadError:
+        return None
+    if entry.newer_than(saved_time):
+        return None   # something was edited after we saved it
+    return entry
+
+def _saveTU(entry, tu_fname, args):
+    if not path.isdir(ast_cache_dir):
+        os.makedirs(ast_cache_dir)
+    try:
+        entry.translation_unit.save(_astFileName(tu_fname, args))
+    except cindex.TranslationUnitSaveError:
+        pass   # the cache is an optimization; we can always parse again
+
+@_synchronized
+def getTranslationUnit(tu_fname, args, verbose=True):
+    """Return the parsed translation unit for a source file and compiler arguments
+
+    Parse results are cached, and refreshed if the source file or any of the headers
+    it includes have been modified since the last parse. If ast_cache_dir is set,
+    parse results are also saved there for use in later sessions.
+    verbose controls printing of parse errors.
+    """
+
+    tu_fname = path.abspath(tu_fname)
+    args = tuple(args)
+    key = (tu_fname, args)
+
+    entry = _tu_cache.get(key)
+    saved_is_stale = False
+    if entry is not None and entry.stale():
+        # reuse libclang's state for the unchanged parts, if we can
+        if entry.reparse():
+            try:
+                _checkDiagnostics(entry.translation_unit, verbose)
+            except RuntimeError:
+                del _tu_cache[key]
+                raise
+            if ast_cache_dir:
+                _saveTU(entry, tu_fname, args)
+        else:
+            del _tu_cache[key]
+            entry = None
+            saved_is_stale = True
+
+    if entry is None and ast_cache_dir and not saved_is_stale:
+        entry = _loadSavedTU(tu_fname, args)
+        if entry is not None:
+            _tu_cache[key] = entry
+
+    if entry is None:
+        try:
+            translation_unit = _getIndex().parse(tu_fname, list(args),
+                                                 options=cindex.TranslationUnit.PARSE_PRECOMPILED_PREAMBLE)
+        except cindex.TranslationUnitLoadError as e:
+            if verbose:
+                print('TranslationUnitLoadError while parsing %s with args:' % tu_fname)
+                print(list(args))
+            raise
+        _checkDiagnostics(translation_unit, verbose)
+        entry = _CachedTU(translation_unit)
+        _tu_cache[key] = entry
+        if ast_cache_dir:
+            _saveTU(entry, tu_fname, args)
+
+    return entry.translation_unit
+
+@_synchronized
+def reparse(fname=None):
+    """Reparse cached translation units that include fname (or all of them, if None)
+
+    Use this after editing a file whose modification time may not have changed.
+    """
+
+    for (tu_fname, args), entry in list(_tu_cache.items()):
+        if fname is None or entry.depends_on(fname):
+            if not entry.reparse():
+                # parsed from source the next time it is wanted, not loaded again
+                del _tu_cache[(tu_fname, args)]
+                if ast_cache_dir:
+                    try:
+                        os.remove(_astFileName(tu_fname, args))
+                    except OSError:
+                        pass
+            elif ast_cache_dir:
+                _saveTU(entry, tu_fname, args)
+
+def getTUMemo(translation_unit):
+    """Return a dict for remembering results computed from a translation unit
+
+    The dict is emptied whenever the translation unit is reparsed, so anything
+    derived from its cursors can be stored here.
+    """
+
+    for entry in _tu_cache.values():
+        if entry.translation_unit is translation_unit:
+            return entry.memo
+    return {}   # not one of ours; nothing will be remembered
+
+@_synchronized
+def clearCache():
+    """Forget all parsed translation units"""
+    _tu_cache.clear()
+
+
+# Parsing can also be started ahead of time, so the parse cost is paid while the
+# user is looking at the current stop rather than when they type "stepu"
+
+class TUPrefetcher:
+    """Parse translation units on a background thread so later lookups find them cached
+
+    Only file names are passed to the worker thread, so requests can be made from
+    gdb event handlers without the worker ever touching gdb. The request queue is
+    bounded; requests that do not fit are dropped. cancel() discards queued
+    requests, though a parse already under way runs to completion.
+
+    thread_class creates the worker. Inside gdb this should be gdb.Thread, which
+    blocks the signals (SIGCHLD, SIGINT...) that gdb expects to handle on its own
+    thread; threading.Thread is only suitable outside gdb.
     """
 
-    compilation_database_path = path.dirname(compdb_fname)
-    index = cindex.Index.create()
+    def __init__(self, maxsize=8, thread_class=threading.Thread):
+        self._queue = queue.Queue(maxsize)
+        self._generation = 0     # bumped on cancel, to invalidate requests in flight
+        self._thread = thread_class(target=self._run, name='tu-prefetch')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prefetch(self, tu_fnames, compdb_fname='./compile_commands.json'):
+        """Queue translation units for parsing, most important first"""
+        gen = self._generation
+        for tu_fname in tu_fnames:
+            try:
+                self._queue.put_nowait((gen, tu_fname, compdb_fname))
+            except queue.Full:
+                break
+
+    def cancel(self):
+        """Discard any requests not yet started"""
+        self._generation += 1
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+    def stop(self):
+        """Cancel outstanding requests and shut down the worker thread"""
+        self.cancel()
+        self._queue.put(None)
+
+    def _run(self):
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            gen, tu_fname, compdb_fname = request
+            if gen != self._generation:
+                continue    # cancelled
+            try:
+                args = getCompilationDatabase(compdb_fname).getCompileArgs(tu_fname)
+                if args is not None:
+                    getTranslationUnit(tu_fname, args, verbose=False)
+            except Exception:
+                # the same error will be reported if the user asks for this TU later
+                pass
+
+
+@_synchronized
+def getCompiledTU(tu_fname, compdb_fname = './compile_commands.json'):
+    """Return the translation unit for a source file, parsed with its flags from the compilation database"""
 
     # Step 1: load the compilation database
-    try:
-        compdb = cindex.CompilationDatabase.fromDirectory(compilation_database_path)
-    except cindex.CompilationDatabaseError:
-        raise RuntimeError('Could not load compilation database for %s'%compilation_database_path)
+    compdb = getCompilationDatabase(compdb_fname)
 
     # Step 2: query compilation flags
-    if tu_fname is None:        # indicates file is the translation unit
-        tu_fname = fname
-    cmds = _getCompileCommands(compdb, tu_fname)
+    args = compdb.getCompileArgs(tu_fname)
 
-    # getCompileCommands signals "not found" with None result
-    if cmds is None:
+    # signal "not found" the same way getCompileCommands does
+    if args is None:
         raise RuntimeError('No compilation flags found for %s'%tu_fname)
 
-    # assuming only one command is required to build
-    cmd = cmds.__getitem__(0)
-
-    # filter irrelevant command line components
-    args = []
-    arg_gen = cmd.arguments
-    next(arg_gen)            # remove compiler executable path
-    for arg in arg_gen:
-        if arg == '-c':
-            # if we don't drop the -c input filename we get a TU parse error...
-            next(arg_gen)    # drop input filename
-        elif arg == '-o':
-            next(arg_gen)    # drop output filename
-        else:
-            args.append(arg)
-
+    # Step 3: parse (or reuse a previous parse)
+    return getTranslationUnit(tu_fname, args)
 
-    try:
-        translation_unit = index.parse(tu_fname, args)
+def getCursorAt(translation_unit, fname, line, column):
+    """Return the AST node at a given location within a translation unit"""
 
-        # TODO: this would be an excellent place to cache the parse results
-        # compilation could take a noticeable amount of time
+    # we can go from TU's primary cursor to a specific file location with:
+    loc = cindex.SourceLocation.from_position(translation_unit,
+                                              translation_unit.get_file(fname),
+                                              line, column)
+    return cindex.Cursor.from_location(translation_unit, loc)
 
-        if (len(translation_unit.diagnostics) > 0):
-            print(['%s:%s'%(x.category_name, x.spelling) for x in translation_unit.diagnostics])
-            raise RuntimeError('Failure during libclang parsing')
-
-        # we can go from TU's primary cursor to a specific file location with:
-        loc = cindex.SourceLocation.from_position(translation_unit,
-                                                  translation_unit.get_file(fname),
-                                                  line, column)
-        cur = cindex.Cursor.from_location(translation_unit, loc)
+@_synchronized
+def getASTNode(fname, line, column, tu_fname = None, compdb_fname = './compile_commands.json'):
+    """Find the enclosing AST node of a given location
 
-        return cur
+    Keyword arguments:
+    fname        -- the file containing the desired node
+    line         -- the line of the node
+    column       -- the column of the node
+    tu_fname     -- the source file containing the compiled translation unit, if different (i.e. if fname was included)
+    compdb_fname -- the file containing the compilation database
+    """
 
-    except cindex.TranslationUnitLoadError as e:
-        print('TranslationUnitLoadError while parsing %s with args:' % tu_fname)
-        print(args)
-        raise
+    if tu_fname is None:        # indicates file is the translation unit
+        tu_fname = fname
+    translation_unit = getCompiledTU(tu_fname, compdb_fname)
+    return getCursorAt(translation_unit, fname, line, column)
 
 
 # supply the next sibling of a statement (for e.g. implementing "next")
@@ -126,26 +428,34 @@ def getASTSibling(parent, node):
 def getFuncName(node):
     """Return the namespace-qualified name of the function in a CALL_EXPR"""
 
+    # the walk up through semantic parents is repeated for every call we examine,
+    # so results are remembered for the life of the parse. Older bindings don't make
+    # Cursors hashable, so we key on clang_hashCursor and compare to resolve collisions.
+    memo = getTUMemo(node.translation_unit)
+    entries = memo.setdefault(('getFuncName', node.hash), [])
+    for cursor, name in entries:
+        if cursor == node:
+            return name
+
     nm = node.spelling
-    node = node.referenced   # jump to function definition
-    while node and node.semantic_parent and node.semantic_parent.kind is not cindex.CursorKind.TRANSLATION_UNIT and node.semantic_parent.spelling:
+    cur = node.referenced   # jump to function definition
+    parent = cur.semantic_parent if cur else None
+    while parent and parent.kind is not cindex.CursorKind.TRANSLATION_UNIT and parent.spelling:
         # accumulate namespaces ("semantic parents" of definition, until TU reached)
-        nm = '%s::%s'%(node.semantic_parent.spelling, nm)
-        node = node.semantic_parent
+        nm = '%s::%s'%(parent.spelling, nm)
+        parent = parent.semantic_parent
+    entries.append((node, nm))
     return nm
 
 def findFirstTU(files, compdb_fname='./compile_commands.json'):
-    """Return the first file found within the compilation database"""
+    """Return the first file found within the compilation database
 
-    compilation_database_path = path.dirname(compdb_fname)
+    files may be any iterable; it is consumed only until a match is found
+    """
 
-    try:
-        compdb = cindex.CompilationDatabase.fromDirectory(compilation_database_path)
-    except cindex.CompilationDatabaseError:
-        raise RuntimeError('Could not load compilation database for %s'%compilation_database_path)
+    compdb = getCompilationDatabase(compdb_fname)
 
     for fn in files:
-        cmds = _getCompileCommands(compdb, fn)
-        if cmds is not None:
+        if compdb.getCompileCommands(fn) is not None:
             return fn
     return None
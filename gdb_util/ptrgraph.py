@@ -0,0 +1,290 @@
+# A small directed graph with just enough of the graph_tool API for leak_dfs
+# Copyright (c) 2018 Jeff Trull
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Vertices are plain integers, numbered from 0 in the order they are added.
+# Edges are stored in parallel arrays of sources and targets, and each vertex
+# has an array of the indices of its out edges. Searches are iterative, so
+# long pointer chains cannot exhaust Python's stack.
+
+from array import array
+
+class StopSearch(Exception):
+    """Raise from a visitor method to end a search early"""
+    pass
+
+class Edge:
+    """A handle for an edge, as passed to visitors and returned by add_edge"""
+
+    __slots__ = ('_src', '_tgt', '_idx')
+
+    def __init__(self, src, tgt, idx):
+        self._src = src
+        self._tgt = tgt
+        self._idx = idx
+
+    def source(self):
+        return self._src
+
+    def target(self):
+        return self._tgt
+
+    def __int__(self):
+        return self._idx
+
+    def __repr__(self):
+        return 'Edge(%d, %d)'%(self._src, self._tgt)
+
+# numeric value types are kept in arrays; anything else in a list
+_typecodes = {'bool': 'b', 'int16_t': 'h', 'int32_t': 'i', 'int64_t': 'q',
+              'int': 'i', 'long': 'q', 'double': 'd', 'float': 'd'}
+_defaults = {'string': ''}
+
+class VertexProperty:
+    """A value for each vertex, which grows along with the graph"""
+
+    def __init__(self, value_type):
+        self.value_type = value_type
+        code = _typecodes.get(value_type)
+        if code is not None:
+            self.a = array(code)
+            self.default = 0
+        else:
+            self.a = []
+            self.default = _defaults.get(value_type)
+
+    def __getitem__(self, v):
+        v = int(v)
+        return self.a[v] if v < len(self.a) else self.default
+
+    def __setitem__(self, v, value):
+        v = int(v)
+        if v >= len(self.a):
+            self.a.extend([self.default] * (v + 1 - len(self.a)))
+        self.a[v] = value
+
+class Graph:
+    """A directed graph that can have vertices and edges added during a search"""
+
+    def __init__(self):
+        self._out = []            # out edge indices of each vertex
+        self._src = array('q')    # source vertex of each edge
+        self._tgt = array('q')    # target vertex of each edge
+
+    def add_vertex(self):
+        self._out.append(array('q'))
+        return len(self._out) - 1
+
+    def add_edge(self, u, v):
+        u, v = int(u), int(v)
+        idx = len(self._tgt)
+        self._src.append(u)
+        self._tgt.append(v)
+        self._out[u].append(idx)
+        return Edge(u, v, idx)
+
+    def num_vertices(self):
+        return len(self._out)
+
+    def num_edges(self):
+        return len(self._tgt)
+
+    def vertices(self):
+        return iter(range(len(self._out)))
+
+    def edges(self):
+        return (Edge(self._src[i], self._tgt[i], i) for i in range(len(self._tgt)))
+
+    def out_edges(self, v):
+        return (Edge(int(v), self._tgt[i], i) for i in self._out[int(v)])
+
+    def out_neighbors(self, v):
+        return (self._tgt[i] for i in self._out[int(v)])
+
+    def new_vertex_property(self, value_type):
+        return VertexProperty(value_type)
+
+class DFSVisitor:
+    """Base class for search visitors; override the events of interest"""
+
+    def initialize_vertex(self, u):
+        pass
+
+    def start_vertex(self, u):
+        pass
+
+    def discover_vertex(self, u):
+        pass
+
+    def examine_edge(self, e):
+        pass
+
+    def tree_edge(self, e):
+        pass
+
+    def back_edge(self, e):
+        pass
+
+    def forward_or_cross_edge(self, e):
+        pass
+
+    def finish_vertex(self, u):
+        pass
+
+_WHITE, _GRAY, _BLACK = 0, 1, 2
+
+def dfs_search(g, source, visitor=DFSVisitor()):
+    """Depth first search from source, reporting events to visitor
+
+    The visitor may add vertices and edges as the search proceeds; the out
+    edges of a vertex are read after it is discovered. Raising StopSearch from
+    the visitor ends the search.
+    """
+
+    source = int(source)
+    color = bytearray(g.num_vertices())
+    for u in range(len(color)):
+        visitor.initialize_vertex(u)
+
+    out, tgt = g._out, g._tgt
+    try:
+        visitor.start_vertex(source)
+        color[source] = _GRAY
+        visitor.discover_vertex(source)
+        stack = [(source, 0)]     # vertex, and the next of its out edges to look at
+        while stack:
+            u, i = stack[-1]
+            adj = out[u]
+            if i == len(adj):
+                color[u] = _BLACK
+                visitor.finish_vertex(u)
+                stack.pop()
+                continue
+            stack[-1] = (u, i + 1)
+            v = tgt[adj[i]]
+            e = Edge(u, v, adj[i])
+            visitor.examine_edge(e)
+            if v >= len(color):
+                # added by the visitor since we started
+                color.extend(bytes(g.num_vertices() - len(color)))
+            if color[v] == _WHITE:
+                visitor.tree_edge(e)
+                color[v] = _GRAY
+                visitor.discover_vertex(v)
+                stack.append((v, 0))
+            elif color[v] == _GRAY:
+                visitor.back_edge(e)
+            else:
+                visitor.forward_or_cross_edge(e)
+    except StopSearch:
+        pass
+
+def label_components(g, directed=True):
+    """Label the (strongly, if directed) connected components of g
+
+    Returns a vertex property of component labels and an array of component sizes.
+    """
+
+    if not directed:
+        return _weak_components(g)
+
+    # Tarjan's algorithm, with explicit stacks
+    n = g.num_vertices()
+    out, tgt = g._out, g._tgt
+    index = array('q', [-1]) * n
+    low = array('q', [0]) * n
+    onstack = bytearray(n)
+    comp = VertexProperty('int64_t')
+    comp.a = array('q', [0]) * n
+    hist = array('q')
+    members = []       # vertices not yet assigned to a component
+    counter = 0
+
+    for s in range(n):
+        if index[s] != -1:
+            continue
+        index[s] = low[s] = counter
+        counter += 1
+        members.append(s)
+        onstack[s] = 1
+        work = [(s, 0)]
+        while work:
+            u, i = work[-1]
+            adj = out[u]
+            if i < len(adj):
+                work[-1] = (u, i + 1)
+                v = tgt[adj[i]]
+                if index[v] == -1:
+                    index[v] = low[v] = counter
+                    counter += 1
+                    members.append(v)
+                    onstack[v] = 1
+                    work.append((v, 0))
+                elif onstack[v] and index[v] < low[u]:
+                    low[u] = index[v]
+                continue
+            work.pop()
+            if work:
+                p = work[-1][0]
+                if low[u] < low[p]:
+                    low[p] = low[u]
+            if low[u] == index[u]:
+                # u is the root of a component; everything above it on the stack belongs to it
+                c = len(hist)
+                size = 0
+                while True:
+                    w = members.pop()
+                    onstack[w] = 0
+                    comp.a[w] = c
+                    size += 1
+                    if w == u:
+                        break
+                hist.append(size)
+    return comp, hist
+
+def _weak_components(g):
+    # union-find over the edges, ignoring direction
+    n = g.num_vertices()
+    parent = array('q', range(n))
+
+    def find(v):
+        root = v
+        while parent[root] != root:
+            root = parent[root]
+        while parent[v] != root:
+            parent[v], v = root, parent[v]
+        return root
+
+    for u, v in zip(g._src, g._tgt):
+        ru, rv = find(u), find(v)
+        if ru != rv:
+            parent[ru] = rv
+
+    comp = VertexProperty('int64_t')
+    comp.a = array('q', [0]) * n
+    labels = {}
+    hist = array('q')
+    for v in range(n):
+        c = labels.setdefault(find(v), len(labels))
+        if c == len(hist):
+            hist.append(0)
+        comp.a[v] = c
+        hist[c] += 1
+    return comp, hist
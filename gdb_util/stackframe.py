@@ -20,136 +20,460 @@
 # SOFTWARE.
 
 import gdb
+import heapq
+import re
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
+from functools import lru_cache
+from itertools import groupby
+
+# type lookups are expensive, and the answers don't change unless code is (un)loaded
+@lru_cache(maxsize=None)
+def _lookup_type(name):
+    return gdb.lookup_type(name)
+
+class SlotMap:
+    """The stack slots (dwords) occupied by a set of symbols, as offsets from the CFA
+
+    offsets is sorted, and labels[i] names the symbols overlapping the slot at offsets[i]
+    """
+
+    def __init__(self, ranges):   # (offset, size, name) for each symbol
+        slots = defaultdict(list)
+        for offset, size, name in ranges:
+            # handle sub-dword quantities by just listing everything that overlaps
+            for slot in range(offset - offset % 0x8, offset + size, 0x8):
+                slots[slot].append(name)
+        self.offsets = array('q', sorted(slots))
+        self.labels = [",".join(slots[offset]) for offset in self.offsets]
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def between(self, cfa, start, end):
+        """Generate (address, label) for each occupied slot from start down to end, exclusive"""
+        lo = bisect_right(self.offsets, end - cfa)
+        hi = bisect_right(self.offsets, start - cfa)
+        for i in range(hi - 1, lo - 1, -1):
+            yield cfa + self.offsets[i], self.labels[i]
+
+    def label(self, cfa, addr):
+        """The label for the slot at addr, or None if it is unoccupied"""
+        i = bisect_left(self.offsets, addr - cfa)
+        if i < len(self.offsets) and self.offsets[i] == addr - cfa:
+            return self.labels[i]
+        return None
+
+class StackLayout:
+    """Where the locals and args of one block of a function live, relative to the CFA"""
+
+    def __init__(self, locls, args):
+        self.locals = SlotMap(locls)
+        self.args = SlotMap(args)
 
 class FramePrinter:
     """Make ASCII art from a stack frame"""
 
+    # StackLayouts by (function, block start); see __layout
+    layouts = {}
+
     def __init__(self, frame):
         self._frame = frame
-        self._decorator = gdb.FrameDecorator.FrameDecorator(self._frame)
+        self.mem = None      # frame contents, once read
+        self.stack = None    # (address, memoryview) of stack memory read for us, if any
+        self.__names = None  # see __locate
 
     def __str__(self):
-        if not self._frame.is_valid():
-            return "<invalid>"
-        result = ""
-        # some basic frame stats
-        if self._frame.function() is not None:
-            result = result + "in " + self._frame.function().name
-            if self._frame.type() is gdb.INLINE_FRAME:
-                # recursively show inlining until we find a "real" parent frame
-                result = result + "\ninlined with" + str(FramePrinter(self._frame.older()))
-        else:
-            result = result + "<unknown function>"
-        if (self._frame.type() != gdb.NORMAL_FRAME):
-            # IDK what else to do
-            return result
-
-        locls = self.__stackmap(self._decorator.frame_locals())
-        args = self.__stackmap(self._decorator.frame_args())
-
-        # assuming we are built with -fno-omit-frame-pointer here.  Not sure how to access
-        # debug info that could tell us more, otherwise. More info is clearly present in C
-        # (otherwise "info frame" could not do its job).
+        result = self.__header()
+        if result[-1] is None:
+            return "".join(result[:-1])
 
         # Display args
         yellow = "\u001b[33m"
         reset_color = "\u001b[0m"
+        sp, cfa, layout = self.sp, self.cfa, self.layout
 
         # find the address range of our args
-        # from there to *(rbp+0x8), exclusive, is the range of possible args
-        if args.keys():
-            first_arg_addr = max(args.keys())    # the one with the highest address
-            result = result + self.__subframe_display(first_arg_addr,
-                                                      self._frame.read_register('rbp')+0x8,
-                                                      args,
-                                                      yellow)
-
-        # *(rbp+0x8) is the stored old IP
-        cyan = "\u001b[36m"
-        result = result + "\n" + str(self._frame.read_register('rbp')+0x8) + " return address"
-        voidstarstar = gdb.lookup_type("void").pointer().pointer()
-        old_ip = (self._frame.read_register('rbp')+0x8).cast(voidstarstar).dereference()
-        result = result + cyan + " (" + str(old_ip) + ")" + reset_color
+        # from there to *(cfa-0x8), exclusive, is the range of possible args
+        if layout.args:
+            result.append(self.__subframe_display(self.first_arg_addr, cfa - 0x8, [(layout.args, yellow)]))
 
-        # *(rbp) is the old RBP
-        result = result + "\n" + str(self._frame.read_register('rbp')+0x0) + " saved rbp"
+        # *(cfa-0x8) is the stored old IP
+        cyan = "\u001b[36m"
+        result.append("\n" + '0x{:02x}'.format(cfa - 0x8) + " return address")
+        old_ip, = struct.unpack_from('<Q', self.mem, cfa - 0x8 - sp)
+        old_ip = gdb.Value(old_ip).cast(_lookup_type("void").pointer())
+        result.append(cyan + " (" + str(old_ip) + ")" + reset_color)
 
-        # print rest of stack, displaying locals
+        # print rest of stack, displaying saved registers (e.g. the old rbp) and locals
         green = "\u001b[32m"
-        result = result + self.__subframe_display(self._frame.read_register('rbp')-0x8,
-                                                  self._frame.read_register('sp')-0x8,
-                                                  locls,
-                                                  green)
+        result.append(self.__subframe_display(cfa - 0x10, sp - 0x8,
+                                              [(self.saved, ""), (layout.locals, green)]))
 
-        result = result + cyan + " <<< top of stack" + reset_color
+        result.append(cyan + " <<< top of stack" + reset_color)
 
+        return "".join(result)
+
+    def diff(self, previous):
+        """Describe only what has changed since an earlier frame's contents()"""
+
+        result = self.__header()
+        if result[-1] is None:
+            return "".join(result[:-1])
+        cyan = "\u001b[36m"
+        magenta = "\u001b[35m"
+        reset_color = "\u001b[0m"
+
+        old_sp, old_mem = previous
+        old_top = old_sp + len(old_mem)
+        if old_sp != self.sp:
+            result.append("\n" + cyan + "top of stack moved from 0x{:02x} to 0x{:02x}".format(old_sp, self.sp) + reset_color)
+        if old_top != self.top:
+            result.append("\n" + cyan + "frame end moved from 0x{:02x} to 0x{:02x}".format(old_top, self.top) + reset_color)
+
+        # compare the part of the stack that both snapshots cover
+        lo = max(old_sp, self.sp)
+        hi = min(old_top, self.top)
+        changed = False
+        if lo < hi:
+            old_bytes = old_mem[lo - old_sp:hi - old_sp]
+            new_bytes = self.mem[lo - self.sp:hi - self.sp].tobytes()
+            # highest address first, as in the full display
+            for offset in reversed(list(_changed_slots(old_bytes, new_bytes, 0, len(new_bytes)))):
+                changed = True
+                addr = lo + offset
+                old_val = int.from_bytes(old_bytes[offset:offset + 0x8], 'little')
+                new_val = int.from_bytes(new_bytes[offset:offset + 0x8], 'little')
+                result.append("\n" + '0x{:02x}'.format(addr) + " " + self.__slot_name(addr) +
+                              magenta + " 0x{:016x} -> 0x{:016x}".format(old_val, new_val) + reset_color)
+        if not changed:
+            result.append("\n(no change)")
+        return "".join(result)
+
+    def contents(self):
+        """The top of stack and the raw frame memory, for a later diff (None if not read)"""
+        if self.mem is None:
+            return None
+        return (self.sp, self.mem.tobytes())
+
+    # Find the function name(s), following any inlining down to the "real" frame
+    # that holds them, and from that frame the registers and layout we need.
+    # Afterwards self.real is that frame, or None if we can't display it, and
+    # self.depth is the number of inlined frames above it
+    def __locate(self):
+        if self.__names is not None:
+            return
+        names = []
+        self.depth = 0
+        self.last = None     # the last valid frame we looked at
+        frame = self._frame
+        while True:
+            if frame is None or not frame.is_valid():
+                names.append("<invalid>")
+                frame = None
+                break
+            self.last = frame
+            # some basic frame stats
+            function = frame.function()
+            names.append("in " + function.name if function is not None else "<unknown function>")
+            if function is not None and frame.type() == gdb.INLINE_FRAME:
+                # show inlining until we find a "real" parent frame
+                names.append("\ninlined with")
+                frame = frame.older()
+                self.depth += 1
+                continue
+            if frame.type() != gdb.NORMAL_FRAME:
+                # IDK what else to do
+                frame = None
+            break
+        self.__names = names
+        self.real = frame
+        if frame is None:
+            return
+
+        # Everything is located relative to the CFA, which gdb finds from the unwind
+        # info, so we don't need a frame pointer. The return address is just below it,
+        # and the unwind info tells us where any registers were saved.
+        self._decorator = gdb.FrameDecorator.FrameDecorator(frame)
+        self.sp = int(frame.read_register('sp'))
+        self.cfa = _cfa(frame)
+        self.layout = self.__layout(self.cfa)
+        self.saved = _saved_registers(frame, self.sp, self.cfa)
+        if self.layout.args:
+            self.first_arg_addr = self.cfa + self.layout.args.offsets[-1]
+
+        # the frame runs from the top of stack through the return address and any args
+        self.top = self.cfa
+        if self.layout.args:
+            self.top = max(self.top, self.first_arg_addr + 0x8)
+
+    def bounds(self):
+        """The (lowest, highest + 1) addresses of our frame, or None if we can't display it"""
+        self.__locate()
+        return (self.sp, self.top) if self.real is not None else None
+
+    # the header lines, followed by None if we can't display the frame.
+    # Otherwise reads the frame memory we need
+    def __header(self):
+        self.__locate()
+        result = list(self.__names)
+        if self.real is None:
+            result.append(None)
+            return result
+        if self.mem is None:
+            if (self.stack is not None and self.stack[0] <= self.sp and
+                self.top <= self.stack[0] + len(self.stack[1])):
+                # someone has read it for us
+                base, buf = self.stack
+                self.mem = buf[self.sp - base:self.top - base]
+            else:
+                # read the whole frame at once
+                self.mem = memoryview(gdb.selected_inferior().read_memory(self.sp, self.top - self.sp))
         return result
 
+    # what we know is in a particular stack slot
+    def __slot_name(self, addr):
+        if addr == self.cfa - 0x8:
+            return "return address"
+        yellow = "\u001b[33m"
+        green = "\u001b[32m"
+        reset_color = "\u001b[0m"
+        for slots, col in ((self.saved, ""), (self.layout.locals, green), (self.layout.args, yellow)):
+            label = slots.label(self.cfa, addr)
+            if label is not None:
+                return col + label + reset_color
+        return "stuff"
+
     # display a range of stack addresses with colors, and compression of unknown contents as "stuff"
+    # only the occupied slots are visited, so large unnamed areas cost nothing
     def __subframe_display(self,
                            start, end,   # range of addresses to display
-                           frame_items,  # map from addresses to lists of symbols
-                           col):         # color to use for the symbols
+                           sources):     # (SlotMap, color) pairs for the things in this range
         magenta = "\u001b[35m"
         reset_color = "\u001b[0m"
-        empty_start = None
-        result = ""
-        for addr in range(start, end, -0x8):
-            addr_hex = '0x{:02x}'.format(addr)
-            if addr in frame_items:
-                if empty_start:
-                    # we just completed an empty range
-                    if empty_start != (addr+0x8):
-                        result = result + magenta + ' (through 0x{:02x})'.format(addr+0x8) + reset_color
-                    empty_start = None
-                result = result + "\n" + addr_hex
-                result = result + " " + col + ",".join([sym.name for sym in frame_items[addr]]) + reset_color
-            elif empty_start is None:
-                # we are starting an empty range
-                empty_start = addr
-                result = result + "\n" + addr_hex + magenta + " stuff" + reset_color
-
-        if empty_start and (empty_start != end+0x8):
-            # the empty range has more than one dword and extended through the end of the subframe
-            result = result + magenta + ' (through ' + str(end+0x8) + ')' + reset_color
+        # merge the sources by address, highest first
+        def colored(slots, col):
+            for slot_addr, label in slots.between(self.cfa, start, end):
+                yield slot_addr, (col + label + reset_color) if col else label
+        labelled = heapq.merge(*[colored(slots, col) for slots, col in sources],
+                               key=lambda item: -item[0])
+        result = []
+        addr = start     # the next address to display
+        for slot_addr, items in groupby(labelled, key=lambda item: item[0]):
+            label = ",".join(item[1] for item in items)
+            if slot_addr != addr:
+                # an empty range precedes this slot
+                result.append("\n" + '0x{:02x}'.format(addr) + magenta + " stuff" + reset_color)
+                if addr != slot_addr + 0x8:
+                    result.append(magenta + ' (through 0x{:02x})'.format(slot_addr + 0x8) + reset_color)
+            result.append("\n" + '0x{:02x}'.format(slot_addr) + " " + label)
+            addr = slot_addr - 0x8
 
-        return result
+        if addr > end:
+            # the empty range extends through the end of the subframe
+            result.append("\n" + '0x{:02x}'.format(addr) + magenta + " stuff" + reset_color)
+            if addr != end + 0x8:
+                result.append(magenta + ' (through 0x{:02x})'.format(end + 0x8) + reset_color)
+
+        return "".join(result)
 
+    # The locations of locals and args relative to the CFA don't change for a given
+    # block of a function, so we only look them up the first time we see it.
+    # After that, displaying a frame only needs its registers.
+    def __layout(self, cfa):
+        try:
+            function = self.real.function()
+            key = (function.name if function else None, self.real.block().start)
+        except RuntimeError:
+            key = None    # no debug info for this pc
+        layout = FramePrinter.layouts.get(key)
+        if layout is None:
+            layout = StackLayout(self.__symbol_ranges(self._decorator.frame_locals(), cfa),
+                                 self.__symbol_ranges(self._decorator.frame_args(), cfa))
+            if key is not None:
+                FramePrinter.layouts[key] = layout
+        return layout
 
-    # produce a dict mapping addresses to symbol lists
-    # for a given list of items (args or locals)
-    def __stackmap(self, frame_items):
-        symbolmap = defaultdict(list)
+    # produce a list of (CFA-relative offset, size, name) for the symbols
+    # in a given list of items (args or locals) that live on the stack
+    def __symbol_ranges(self, frame_items, cfa):
+        ranges = []
         if not frame_items:
-            return symbolmap
+            return ranges
 
         for i in frame_items:
-            name = i.symbol().name
-            addr = self._frame.read_var(name).address
+            sym = i.symbol()
+            if isinstance(sym, str):
+                name = sym
+            elif sym.addr_class == gdb.SYMBOL_LOC_STATIC:
+                continue    # not on the stack
+            else:
+                name = sym.name
+            value = self.real.read_var(sym)
+            addr = value.address
             if not addr == None:
                 # gdb.Value is not "hashable"; keys must be something else
-                # so here we use addr converted to int
-                sz = i.symbol().type.sizeof
-                # mark all dwords in the stack with this symbol
-                addr = addr.cast(gdb.lookup_type("void").pointer()) # cast to void*
-                # handle sub-dword quantities by just listing everything that overlaps
-                for saddr in range(addr, addr+sz, 0x8):
-                    symbolmap[int(saddr)].append(i.symbol())
-        return symbolmap
+                # so here we use the offset from the CFA as an int
+                offset = int(addr.cast(_lookup_type("void").pointer())) - cfa
+                ranges.append((offset, value.type.sizeof, name))
+        return ranges
+
+# Find the offsets of the dwords that differ between two equal-length byte strings.
+# Halves that compare equal (a single memcmp) are skipped, so this is fast when
+# only a few slots have changed.
+def _changed_slots(old, new, lo, hi):
+    if old[lo:hi] == new[lo:hi]:
+        return
+    if hi - lo <= 0x8:
+        yield lo
+        return
+    mid = lo + (hi - lo) // 0x10 * 0x8
+    yield from _changed_slots(old, new, lo, mid)
+    yield from _changed_slots(old, new, mid, hi)
+
+# the Canonical Frame Address: the caller's stack pointer, just above our return address
+def _cfa(frame):
+    caller = frame.older()
+    if caller is not None:
+        return int(caller.read_register('sp'))
+    # The outermost frame has no caller to unwind to, but gdb identifies frames by
+    # their CFA, and (from gdb 14) shows it in a frame's repr
+    m = re.search(r'stack=(0x[0-9a-f]+)', repr(frame))
+    if m:
+        return int(m.group(1), 16)
+    # otherwise all we can do is hope there is a frame pointer
+    return int(frame.read_register('rbp')) + 0x10
+
+# Where registers are saved relative to the CFA depends only on the pc, so we
+# remember it for the pcs we have seen. gdb has already parsed the unwind info, so
+# we ask it with "info frame", which lists the save slots; that costs one command
+# per new pc. The cache is bounded, as a watchpoint on the stack pointer stops at a
+# new pc almost every time.
+_saved_regs = {}
+_saved_regs_max = 4096
+
+def _frame_info(frame):
+    """The output of "info frame" for frame, without reading the values of its args"""
+
+    selected = gdb.selected_frame()
+    arguments = gdb.parameter('print frame-arguments')
+    frame.select()
+    try:
+        # the saved registers are all we want; "info frame" would read every arg too
+        try:
+            gdb.execute('set print frame-arguments presence', to_string = True)
+        except gdb.error:
+            gdb.execute('set print frame-arguments none', to_string = True)   # before gdb 10
+        return gdb.execute('info frame', to_string = True)
+    finally:
+        gdb.execute('set print frame-arguments %s'%arguments, to_string = True)
+        selected.select()
+
+def _saved_registers(frame, sp, cfa):
+    """A SlotMap of the registers frame has saved on the stack, apart from the return address"""
+
+    pc = frame.pc()
+    slots = _saved_regs.get(pc)
+    if slots is None:
+        ranges = []
+        saved = _frame_info(frame).split('Saved registers:', 1)
+        if len(saved) == 2:
+            for reg, addr in re.findall(r'([a-z0-9]+) at (0x[0-9a-f]+)', saved[1]):
+                addr = int(addr, 16)
+                # a register frame left alone may have been saved by one of its callees
+                if reg not in ('rip', 'pc') and sp <= addr < cfa - 0x8:
+                    ranges.append((addr - cfa, 0x8, 'saved ' + reg))
+        slots = SlotMap(ranges)
+        if len(_saved_regs) >= _saved_regs_max:
+            _saved_regs.clear()
+        _saved_regs[pc] = slots
+    return slots
+
+def _clear_caches(event):
+    _lookup_type.cache_clear()
+    FramePrinter.layouts.clear()
+    _saved_regs.clear()
+
+gdb.events.clear_objfiles.connect(_clear_caches)
 
 # Now create a gdb command that prints the current stack:
 class PrintFrame (gdb.Command):
-    """Display the stack memory layout for the current frame"""
+    """Display the stack memory layout for the current frame
+
+    Usage: pframe [--diff | all | N..M]
+
+    With --diff, only the stack slots whose contents have changed since the last
+    pframe are shown, along with any movement of the top of stack or the end of the
+    frame. This is much quicker to read (and display) when run on every change of $rsp.
+
+    "pframe all" shows every frame on the stack, and "pframe N..M" frames N through M
+    (as numbered by "backtrace"). The stack memory for all of them is read at once.
+    """
+
+    previous = None    # the frame contents from the last pframe
+
+    # reading more than this at once probably means the frames aren't on one stack
+    max_stack_read = 64 * 1024 * 1024
 
     def __init__ (self):
         super (PrintFrame, self).__init__ ("pframe", gdb.COMMAND_STACK)
 
+    @staticmethod
+    def _frames(first, last):
+        """Generate (level, FramePrinter) for each frame from level first to last (None for all)"""
+
+        frame = gdb.newest_frame()
+        level = 0
+        while frame is not None and (last is None or level <= last):
+            printer = FramePrinter(frame)
+            printer.bounds()
+            # a printer covers any inlined frames along with the one containing them
+            if level + printer.depth >= first:
+                yield level, printer
+            level += printer.depth + 1
+            frame = printer.last.older() if printer.last is not None else None
+
+    @staticmethod
+    def _print_frames(first, last):
+        printers = list(PrintFrame._frames(first, last))
+
+        # read the stack for all of them in one go
+        spans = [p.bounds() for _, p in printers if p.bounds() is not None]
+        if spans:
+            lo = min(sp for sp, _ in spans)
+            hi = max(top for _, top in spans)
+            if hi - lo <= PrintFrame.max_stack_read:
+                try:
+                    stack = (lo, memoryview(gdb.selected_inferior().read_memory(lo, hi - lo)))
+                except gdb.MemoryError:
+                    stack = None    # each frame will try for itself
+                for _, p in printers:
+                    p.stack = stack
+
+        print("\n".join("#%d %s"%(level, p) for level, p in printers))
+
     def invoke (self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        frame_range = None
+        if argv == ['all']:
+            frame_range = (0, None)
+        elif len(argv) == 1 and re.match(r'^[0-9]+\.\.[0-9]+$', argv[0]):
+            frame_range = tuple(int(n) for n in argv[0].split('..'))
+        elif argv not in ([], ['--diff']):
+            raise gdb.GdbError('usage: pframe [--diff | all | N..M]')
         try:
-            print(FramePrinter(gdb.newest_frame()))
+            if frame_range is not None:
+                PrintFrame._print_frames(*frame_range)
+                return
+            printer = FramePrinter(gdb.newest_frame())
+            if argv and PrintFrame.previous is not None:
+                print(printer.diff(PrintFrame.previous))
+            else:
+                print(printer)
+            PrintFrame.previous = printer.contents() or PrintFrame.previous
         except gdb.error:
             print("gdb got an error. Maybe we are not currently running?")
 
 PrintFrame ()
-
@@ -21,10 +21,77 @@
 
 import gdb
 import re
+import itertools
+import signal
+import threading
+from collections import OrderedDict
 
-from gdb_util.libclang_helpers import getASTNode, getASTSibling, getFuncName, findFirstTU
+from gdb_util import libclang_helpers
+from gdb_util.libclang_helpers import getCompiledTU, getCursorAt, getTUMemo, getASTSibling, getFuncName, findFirstTU
 from clang.cindex import CursorKind
 
+# Resolving a breakpoint location means searching every loaded objfile, which in a
+# large program costs far more than anything else stepu does. Since stepping in a
+# loop asks for the same locations over and over, we keep our internal breakpoints
+# around, disabled, and just turn them back on the next time they are wanted.
+class BreakpointPool:
+    """A bounded set of reusable internal breakpoints, keyed by location spec"""
+
+    def __init__ (self, maxSize = 256):
+        self.maxSize = maxSize
+        self._bps = OrderedDict()    # spec -> gdb.Breakpoint, least recently used first
+        self._held = set()           # disabled, but still wanted; not to be evicted
+        gdb.events.clear_objfiles.connect(self._onClearObjfiles)
+        if hasattr(gdb.events, 'free_objfile'):    # gdb 13+
+            gdb.events.free_objfile.connect(self._onClearObjfiles)
+
+    def acquire (self, spec):
+        """Return an enabled internal breakpoint at spec"""
+        bp = self._bps.pop(spec, None)
+        if bp is None or not bp.is_valid():
+            bp = gdb.Breakpoint(spec, internal=True)
+        else:
+            bp.enabled = True
+        self._bps[spec] = bp
+        self._evict()
+        return bp
+
+    def hold (self, bp):
+        """Keep a breakpoint from being evicted, even while disabled, until it is released"""
+        self._held.add(bp)
+
+    def release (self, bp):
+        """Return a breakpoint obtained from acquire() to the pool"""
+        self._held.discard(bp)
+        if bp.is_valid():
+            bp.enabled = False
+
+    def clear (self):
+        """Delete all pooled breakpoints"""
+        for bp in self._bps.values():
+            if bp.is_valid():
+                bp.delete()
+        self._bps.clear()
+        self._held.clear()
+
+    def _evict (self):
+        # drop the least recently used idle breakpoints until we are within our limit
+        excess = len(self._bps) - self.maxSize
+        for spec in list(self._bps):
+            if excess <= 0:
+                break
+            bp = self._bps[spec]
+            if bp.is_valid() and (bp.enabled or bp in self._held):
+                continue    # in use
+            del self._bps[spec]
+            if bp.is_valid():
+                bp.delete()
+            excess -= 1
+
+    def _onClearObjfiles (self, event):
+        # the code our breakpoints were resolved against has gone away
+        self.clear()
+
 # Set breakpoints on "downstream" user code, continue until you reach one, then remove breakpoints
 class StepUser (gdb.Command):
     """Step to the next user code"""
@@ -35,61 +102,54 @@ class StepUser (gdb.Command):
     # class globals
     finishBP = None       # for remembering where to resume
     stepRegex = None      # for identifying "library" (skippable) calls
+    compdbFname = './compile_commands.json'
+    prefetcher = None     # background parser, if stepu-prefetch is on
+    bpPool = BreakpointPool()
 
     def invoke (self, arg, from_tty):
-        parent = None
-        try:
-            # find the AST node closest to the beginning of the current line
-            frame = gdb.newest_frame()
-            line = frame.find_sal().line
-            fname = frame.find_sal().symtab.filename
-            compdb_fname = './compile_commands.json'
-
-            # If the current file is not the base TU (the source that was compiled), find it by looking up the stack
-            # prepare a list of candidates by looking at the stack
-            files = []
-            while frame is not None:
-                files.append(frame.find_sal().symtab.filename)
-                frame = frame.older()
-            tu_fname = findFirstTU(files)
-            if tu_fname is None:
-                raise RuntimeError('cannot find the translation unit for file %s'%fname)
-
-            node = getASTNode(fname, line, 1, tu_fname, compdb_fname)
-            # If the location of this node is prior to the current line, it probably represents
-            # the parent to our desired node. Find the first child at or after our desired location.
-            if node.location.line < line:
-                parent = node
-                node = next(cur for cur in node.get_children() if cur.location.line >= line)
-            elif node.kind == CursorKind.FUNCTION_DECL:
-                # the body is a compound statement at the end of the children
-                parent = node
-                node = list(parent.get_children())[-1]
-                if node.kind == CursorKind.COMPOUND_STMT and len(list(node.get_children())) > 0:
-                    # grab the first statement
-                    parent = node
-                    node = next(parent.get_children())
-
-            # Flag error if none
-            if node is None:
-                raise RuntimeError('Cannot find breakpoint location for line %d'%line)
-
-            breakpoints = self._breakInFunctions(node)
-
-        except gdb.error:
-            print("gdb got an error trying to find our location. Maybe we are not currently running?")
-
-        # ensure we don't duplicate any breakpoints
-        breakpoints = list(set(breakpoints))
+        if StepUser.prefetcher is not None:
+            # we need the parser for our own TU now
+            StepUser.prefetcher.cancel()
+
+        # libclang objects must not be used while a background parse is running
+        with libclang_helpers.parse_lock:
+            try:
+                # find the AST node closest to the beginning of the current line
+                frame = gdb.newest_frame()
+                line = frame.find_sal().line
+                fname = frame.find_sal().symtab.filename
+                compdb_fname = StepUser.compdbFname
+
+                # If the current file is not the base TU (the source that was compiled), find it by looking up the stack
+                # candidates are generated from the stack only as far as needed to find one
+                tu_fname = findFirstTU(StepUser._stackFiles(frame), compdb_fname)
+                if tu_fname is None:
+                    raise RuntimeError('cannot find the translation unit for file %s'%fname)
+
+                # the breakpoint locations for a line only change if the TU is reparsed,
+                # so stepping through the same code again is just a lookup
+                translation_unit = getCompiledTU(tu_fname, compdb_fname)
+                memo = getTUMemo(translation_unit)
+                key = ('stepu', fname, line, StepUser.stepRegex)
+                if key not in memo:
+                    memo[key] = StepUser._analyzeLine(translation_unit, fname, line)
+                breakpoints, nextLoc = memo[key]
+
+            except gdb.error:
+                print("gdb got an error trying to find our location. Maybe we are not currently running?")
+                return
+
+        # the previous finish breakpoint can't be used any more. Release it first, as
+        # it may be the very breakpoint the pool hands us for one of the new locations
+        StepUser._releaseFinishBP()
 
         # turn them into gdb breakpoints
-        breakpoints = [gdb.Breakpoint('%s:%d'%x, internal=True) for x in breakpoints]
+        breakpoints = [StepUser.bpPool.acquire('%s:%d'%x) for x in breakpoints]
 
         # set a "finish" breakpoint for the node following ours in the AST
         # i.e., the next child of the CompoundStmt
         # or the end of the frame, if we are the last
-        nextStmt = getASTSibling(parent, node)
-        if nextStmt is None:
+        if nextLoc is None:
             if gdb.newest_frame().older() is not None:
                 # create default finish breakpoint
                 StepUser.finishBP = gdb.FinishBreakpoint(internal=True)  # on by default in case no other breakpoints happen
@@ -98,7 +158,9 @@ class StepUser (gdb.Command):
                 StepUser.finishBP = None
         else:
             # use nextStmt info to set breakpoint
-            StepUser.finishBP = gdb.Breakpoint('%s:%d'%(nextStmt.location.file.name, nextStmt.location.line), internal=True)
+            StepUser.finishBP = StepUser.bpPool.acquire('%s:%d'%nextLoc)
+            # finishu will want it after we disable it below
+            StepUser.bpPool.hold(StepUser.finishBP)
 
         # continue until breakpoint hit
         err = None
@@ -107,9 +169,10 @@ class StepUser (gdb.Command):
         except gdb.error as e:
             err = e
 
-        # delete our breakpoints
+        # disable our breakpoints until they are needed again
         for bp in breakpoints:
-            bp.delete()
+            if bp is not StepUser.finishBP:
+                StepUser.bpPool.release(bp)
 
         if StepUser.finishBP and StepUser.finishBP.is_valid():
             # disable "finish" breakpoint
@@ -117,15 +180,85 @@ class StepUser (gdb.Command):
         else:
             # we must have hit this guard breakpoint
             # there is nowhere to continue to
-            StepUser.finishBP = None
+            StepUser._releaseFinishBP()
 
         # rethrow any errors
         if err:
             raise err
 
+    @staticmethod
+    def _releaseFinishBP():
+        bp = StepUser.finishBP
+        StepUser.finishBP = None
+        if bp is None:
+            return
+        if isinstance(bp, gdb.FinishBreakpoint):
+            if bp.is_valid():
+                bp.delete()    # tied to a particular frame; never reusable
+        else:
+            StepUser.bpPool.release(bp)
+
+    @staticmethod
+    def _stackFiles(frame):
+        """Generate the source file names of this frame and its callers"""
+        while frame is not None:
+            symtab = frame.find_sal().symtab
+            if symtab is not None:
+                yield symtab.filename
+            frame = frame.older()
+
+    @staticmethod
+    def _analyzeLine(translation_unit, fname, line):
+        """Find where stepu from this line should stop
+
+        Returns a list of (file, line) breakpoint locations in user code called
+        from this line, and the (file, line) of the following statement, or None
+        if there isn't one.
+        """
+
+        parent = None
+        node = getCursorAt(translation_unit, fname, line, 1)
+        # If the location of this node is prior to the current line, it probably represents
+        # the parent to our desired node. Find the first child at or after our desired location.
+        if node.location.line < line:
+            parent = node
+            node = next(cur for cur in node.get_children() if cur.location.line >= line)
+        elif node.kind == CursorKind.FUNCTION_DECL:
+            # the body is a compound statement at the end of the children
+            parent = node
+            node = list(parent.get_children())[-1]
+            if node.kind == CursorKind.COMPOUND_STMT:
+                first_stmt = next(node.get_children(), None)
+                if first_stmt is not None:
+                    # grab the first statement
+                    parent = node
+                    node = first_stmt
+
+        # Flag error if none
+        if node is None:
+            raise RuntimeError('Cannot find breakpoint location for line %d'%line)
+
+        # ensure we don't duplicate any breakpoints
+        breakpoints = list(set(StepUser._breakInFunctions(node)))
+
+        nextStmt = getASTSibling(parent, node)
+        if nextStmt is None:
+            return breakpoints, None
+        return breakpoints, (nextStmt.location.file.name, nextStmt.location.line)
+
     # call expressions are a bit funny
     # I experimented with the AST a bit to come up with these:
 
+    # Each of these fetches a node's children only once, as every call goes through libclang
+
+    @staticmethod
+    def _onlyChild(node, kind):
+        """Return the single child of node if it has the given kind, otherwise None"""
+        children = list(node.get_children())
+        if len(children) != 1 or children[0].kind != kind:
+            return None
+        return children[0]
+
     @staticmethod
     def _getMemberBody(node):
         # member function calls have a weird structure:
@@ -133,22 +266,24 @@ class StepUser (gdb.Command):
         # which has a MEMBER_REF_EXPR child
         if node.kind is not CursorKind.CALL_EXPR:
             return None
-        if len(list(node.get_children())) != 1 or next(node.get_children()).kind != CursorKind.UNEXPOSED_EXPR:
+        unexp_node = StepUser._onlyChild(node, CursorKind.UNEXPOSED_EXPR)
+        if unexp_node is None:
             return None
-        unexp_node = next(node.get_children())
-        if len(list(unexp_node.get_children())) != 1 or next(unexp_node.get_children()).kind != CursorKind.CALL_EXPR:
+        gchild_node = StepUser._onlyChild(unexp_node, CursorKind.CALL_EXPR)
+        if gchild_node is None:
             return None
-        gchild_node = next(unexp_node.get_children())
         # now we have a CALL_EXPR. The first child should be information about the function itself
-        if len(list(gchild_node.get_children())) != 1 or next(gchild_node.get_children()).kind != CursorKind.MEMBER_REF_EXPR:
+        if StepUser._onlyChild(gchild_node, CursorKind.MEMBER_REF_EXPR) is None:
             return None
 
         # Now we want this CALL_EXPR's referenced definition (which we know is a member function)
-        if not gchild_node.referenced or len(list(gchild_node.referenced.get_children())) != 2:
+        definition = gchild_node.referenced
+        if not definition:
             return None
-        child_it = gchild_node.referenced.get_children()
-        next(child_it)     # discard declaration stuff, for now
-        body = next(child_it)
+        children = list(definition.get_children())
+        if len(children) != 2:
+            return None
+        body = children[1]   # discard declaration stuff, for now
         if body.kind is not CursorKind.COMPOUND_STMT:
             return None
 
@@ -159,12 +294,12 @@ class StepUser (gdb.Command):
         # CALL_EXPR with one UNEXPOSED_EXPR child, which in turn has a LAMBDA_EXPR child
         if node.kind is not CursorKind.CALL_EXPR:
             return None
-        if len(list(node.get_children())) != 1 or next(node.get_children()).kind is not CursorKind.UNEXPOSED_EXPR:
+        unexp_node = StepUser._onlyChild(node, CursorKind.UNEXPOSED_EXPR)
+        if unexp_node is None:
             return None
-        unexp_node = next(node.get_children())
-        if len(list(unexp_node.get_children())) != 1 or next(unexp_node.get_children()).kind is not CursorKind.LAMBDA_EXPR:
+        lexpr = StepUser._onlyChild(unexp_node, CursorKind.LAMBDA_EXPR)
+        if lexpr is None:
             return None
-        lexpr = next(unexp_node.get_children())
         # the *last* child should be the body
         body = list(lexpr.get_children())[-1]
         if body.kind is not CursorKind.COMPOUND_STMT:
@@ -175,13 +310,15 @@ class StepUser (gdb.Command):
     def _getFunctionBody(node):
         # a regular named function seems to get the simplest treatment:
         # you can use "referenced" to get the definition
-        if not node.referenced:
+        definition = node.referenced
+        if not definition:
             return None
 
-        if len(list(node.referenced.get_children())) == 0:
+        children = list(definition.get_children())
+        if len(children) == 0:
             return None   # we at least need a body node
 
-        body = list(node.referenced.get_children())[-1]
+        body = children[-1]
         if body.kind is not CursorKind.COMPOUND_STMT:
             return None   # not sure why this would ever be true but...
 
@@ -207,9 +344,10 @@ class StepUser (gdb.Command):
         # If the child is an "unexposed expression" find its child.
         if node.kind.is_unexposed():
             # Flag error if none or more than one
-            if len(list(node.get_children())) != 1:
+            children = list(node.get_children())
+            if len(children) != 1:
                 raise RuntimeError('Unexposed expression at line %d has more than one child, unsure how to handle'%node.location.line)
-            node = next(node.get_children())
+            node = children[0]
 
         if node.kind.is_unexposed():
             raise RuntimeError('parent and child AST nodes both unexposed at line %d'%node.location.line)
@@ -244,15 +382,16 @@ class StepUser (gdb.Command):
             if not re.match(StepUser.stepRegex, getFuncName(decl)):
                 # locate member function bodies and breakpoint
                 members = [next(x.get_children()) for x in StepUser._getMethodBodies(decl)]
-                breakpoints.append = (breakpoints +
-                                      [(x.location.file.name, x.location.line) for x in members])
+                breakpoints = (breakpoints +
+                               [(x.location.file.name, x.location.line) for x in members])
 
         elif node.kind == CursorKind.LAMBDA_EXPR:
             # break on first body statement, if present
             body = list(node.get_children())[-1]
-            if body.kind == CursorKind.COMPOUND_STMT and len(list(body.get_children())) > 0:
-                first_stmt = next(body.get_children())
-                breakpoints.append((first_stmt.location.file.name, first_stmt.location.line))
+            if body.kind == CursorKind.COMPOUND_STMT:
+                first_stmt = next(body.get_children(), None)
+                if first_stmt is not None:
+                    breakpoints.append((first_stmt.location.file.name, first_stmt.location.line))
 
         return breakpoints
 StepUser ()
@@ -267,7 +406,11 @@ class FinishUser (gdb.Command):
     def invoke (self, arg, from_tty):
         if StepUser.finishBP and StepUser.finishBP.is_valid():
             StepUser.finishBP.enabled = True
-            gdb.execute("continue")
+            try:
+                gdb.execute("continue")
+            finally:
+                # we've arrived (or been interrupted); don't stop here again
+                StepUser._releaseFinishBP()
         else:
             print('no previous stepu command found, or previous stepu was called from outermost frame')
 FinishUser()
@@ -294,3 +437,121 @@ class StepUserIgnoreRegex (gdb.Parameter):
         return StepUser.stepRegex
 
 StepUserIgnoreRegex()
+
+# Let users keep parsed translation units on disk between sessions
+class StepUserASTCacheDir (gdb.Parameter):
+    """Directory for saving libclang parse results between gdb sessions
+
+    Translation units are always cached for the current session. If this is set,
+    they are also saved here, and reloaded by later sessions if none of the
+    files they were parsed from have been modified since.
+    """
+
+    set_doc = "set this to a directory to keep parsed translation units between sessions"
+    show_doc = "show this to see where parsed translation units are kept"
+
+    def __init__ (self):
+        super (StepUserASTCacheDir, self).__init__ ("stepu-ast-cache-dir",
+                                                    gdb.COMMAND_RUNNING,
+                                                    gdb.PARAM_OPTIONAL_FILENAME)
+
+    # required API
+    def get_set_string(self):
+        libclang_helpers.ast_cache_dir = self.value if self.value else None
+        return self.value
+
+    def get_show_string(self, svalue):
+        return svalue
+
+StepUserASTCacheDir()
+
+# Refresh parse results after editing a file
+class StepUserReparse (gdb.Command):
+    """Reparse the translation units that include FILE (all of them if no FILE given)"""
+
+    def __init__ (self):
+        super (StepUserReparse, self).__init__ ("stepu-reparse", gdb.COMMAND_FILES)
+
+    def invoke (self, arg, from_tty):
+        libclang_helpers.reparse(arg if arg else None)
+
+StepUserReparse()
+
+# The prefetch worker must not receive the signals gdb handles itself (SIGCHLD, SIGINT...).
+# gdb.Thread (gdb 12 and later) takes care of that; with older versions we block them
+# while starting the thread, which inherits our signal mask.
+if hasattr(gdb, 'Thread'):
+    _PrefetchThread = gdb.Thread
+else:
+    class _PrefetchThread(threading.Thread):
+        def start(self):
+            old = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD, signal.SIGINT,
+                                                           signal.SIGALRM, signal.SIGWINCH])
+            try:
+                super(_PrefetchThread, self).start()
+            finally:
+                signal.pthread_sigmask(signal.SIG_SETMASK, old)
+
+# Parse translation units for the current stack whenever we stop, so stepu finds them ready
+def _prefetchOnStop(event):
+    try:
+        frame = gdb.newest_frame()
+    except gdb.error:
+        return
+    # each frame's TU is the first one found looking up the stack from it, so
+    # successive searches can resume where the previous one left off
+    tus = []
+    try:
+        files = list(itertools.islice(StepUser._stackFiles(frame), StepUserPrefetch.maxDepth))
+        idx = 0
+        while idx < len(files):
+            tu_fname = findFirstTU(files[idx:], StepUser.compdbFname)
+            if tu_fname is None:
+                break
+            if tu_fname not in tus:
+                tus.append(tu_fname)
+            idx = files.index(tu_fname, idx) + 1
+    except (gdb.error, RuntimeError):
+        return   # e.g. no compilation database; stepu will report it if used
+    StepUser.prefetcher.prefetch(tus, StepUser.compdbFname)
+
+def _cancelPrefetch(event):
+    StepUser.prefetcher.cancel()
+
+class StepUserPrefetch (gdb.Parameter):
+    """Parse translation units for frames on the stack in the background each time the inferior stops
+
+    Parsing happens on a separate thread, so a following stepu finds the AST ready.
+    Outstanding requests are cancelled when the inferior resumes.
+    """
+
+    set_doc = "set this to on to parse translation units ahead of stepu"
+    show_doc = "show this to see whether translation units are parsed ahead of stepu"
+
+    maxDepth = 64         # frames examined for each stop
+
+    def __init__ (self):
+        super (StepUserPrefetch, self).__init__ ("stepu-prefetch",
+                                                 gdb.COMMAND_RUNNING,
+                                                 gdb.PARAM_BOOLEAN)
+        self.value = False   # default: parse on demand
+
+    # required API
+    def get_set_string(self):
+        if self.value and StepUser.prefetcher is None:
+            StepUser.prefetcher = libclang_helpers.TUPrefetcher(thread_class = _PrefetchThread)
+            gdb.events.stop.connect(_prefetchOnStop)
+            gdb.events.cont.connect(_cancelPrefetch)
+            gdb.events.exited.connect(_cancelPrefetch)
+        elif not self.value and StepUser.prefetcher is not None:
+            gdb.events.stop.disconnect(_prefetchOnStop)
+            gdb.events.cont.disconnect(_cancelPrefetch)
+            gdb.events.exited.disconnect(_cancelPrefetch)
+            StepUser.prefetcher.stop()
+            StepUser.prefetcher = None
+        return 'on' if self.value else 'off'
+
+    def get_show_string(self, svalue):
+        return svalue
+
+StepUserPrefetch()
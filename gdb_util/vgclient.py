@@ -0,0 +1,177 @@
+# A client for Valgrind gdbserver monitor commands, and a fake valgrind to test it with
+# Copyright (c) 2018 Jeff Trull
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Monitor commands are queued with a callback for their output, then sent back to
+# back when the queue is flushed. The default transport sends them through gdb's
+# "monitor" command; FakeVgdb can stand in for it, so code using the client can be
+# run without gdb or valgrind. Nothing here imports gdb until it is needed.
+
+import time
+from collections import deque, namedtuple
+
+def gdb_transport(commands):
+    """Send monitor commands to valgrind through gdb, generating each one's output"""
+    import gdb
+    for cmd in commands:
+        yield gdb.execute('monitor %s'%cmd, to_string = True)
+
+# the timing of one completed request; all times are in seconds
+Timing = namedtuple('Timing', ['command', 'queued', 'elapsed'])
+
+class MonitorClient:
+    """Queue valgrind monitor commands and hand their output to callbacks
+
+    submit() queues a command; flush() sends everything queued and calls each
+    callback with its command's output, in order. If log is set, it is called
+    with a message for each request (time taken, and time spent in the queue)
+    and one for each flush.
+    """
+
+    def __init__(self, transport = gdb_transport, log = None):
+        self.transport = transport
+        self.log = log
+        self._queue = deque()    # (command, callback, time submitted)
+        self.timings = deque(maxlen = 1000)   # most recent requests
+
+    def submit(self, command, callback = None):
+        self._queue.append((command, callback, time.monotonic()))
+
+    def pending(self):
+        return len(self._queue)
+
+    def flush(self):
+        """Send all queued commands, calling their callbacks as the results arrive"""
+
+        if not self._queue:
+            return
+        batch = list(self._queue)
+        self._queue.clear()
+        start = last = time.monotonic()
+        results = self.transport([cmd for cmd, _, _ in batch])
+        for (cmd, callback, submitted), text in zip(batch, results):
+            now = time.monotonic()
+            timing = Timing(cmd, now - submitted, now - last)
+            self.timings.append(timing)
+            if self.log:
+                self.log('%s: %.1f ms (%.1f ms since queued)'%(cmd, timing.elapsed * 1000, timing.queued * 1000))
+            if callback is not None:
+                callback(text)
+            last = time.monotonic()
+        if self.log:
+            self.log('%d requests in %.1f ms'%(len(batch), (time.monotonic() - start) * 1000))
+
+    def execute(self, command):
+        """Send a command (and anything already queued) and return its output"""
+
+        result = []
+        self.submit(command, result.append)
+        self.flush()
+        return result[0]
+
+class FakeVgdb:
+    """An in-process stand-in for valgrind's gdbserver, for use as a MonitorClient transport
+
+    blocks is a dict of block addresses to (size, [addresses of blocks it points to]).
+    lost is a list of loss records, each a list of the addresses of the definitely
+    lost blocks in it; the blocks those point to are reported as indirectly lost.
+    Every command takes delay seconds, to stand in for valgrind scanning the heap.
+    leak_check, block_list and who_points_at are understood, in the same format as
+    valgrind's, and commands gives every command received.
+    """
+
+    def __init__(self, blocks, lost = (), delay = 0):
+        self.blocks = blocks
+        self.lost = [list(rec) for rec in lost]
+        self.delay = delay
+        self.commands = []
+
+    def __call__(self, commands):
+        for cmd in commands:
+            self.commands.append(cmd)
+            if self.delay:
+                time.sleep(self.delay)
+            words = cmd.split()
+            handler = getattr(self, '_' + words[0], None)
+            yield handler(words[1:]) if handler else "command '%s' not recognised\n"%words[0]
+
+    @staticmethod
+    def _trace(addr):
+        return ('   at 0x4C2E0EF: malloc (vg_replace_malloc.c:299)\n'
+                '   by 0x{:X}: alloc_{:x} (fake.c:1)\n'.format(0x400000 + addr % 0x100000, addr))
+
+    def _indirect(self, roots):
+        # the blocks reachable from roots, apart from the roots themselves
+        seen = set(roots)
+        work = list(roots)
+        while work:
+            for p in self.blocks[work.pop()][1]:
+                if p in self.blocks and p not in seen:
+                    seen.add(p)
+                    work.append(p)
+        return sorted(seen - set(roots))
+
+    def _header(self, n):
+        roots = self.lost[n - 1]
+        direct = sum(self.blocks[a][0] for a in roots)
+        indirect = sum(self.blocks[a][0] for a in self._indirect(roots))
+        return ('%d (%d direct, %d indirect) bytes in %d blocks are definitely lost in loss record %d of %d\n'%(
+                direct + indirect, direct, indirect, len(roots), n, len(self.lost)) +
+                self._trace(roots[0]))
+
+    def _leak_check(self, args):
+        lines = [self._header(n) for n in range(1, len(self.lost) + 1)]
+        roots = [a for rec in self.lost for a in rec]
+        indirect = self._indirect(roots)
+        lines.append('LEAK SUMMARY:\n')
+        lines.append('   definitely lost: %d bytes in %d blocks\n'%(sum(self.blocks[a][0] for a in roots), len(roots)))
+        lines.append('   indirectly lost: %d bytes in %d blocks\n'%(sum(self.blocks[a][0] for a in indirect), len(indirect)))
+        return ''.join(lines)
+
+    def _block_list(self, args):
+        n = int(args[0])
+        if not 1 <= n <= len(self.lost):
+            return 'invalid loss record nr\n'
+        lines = [self._header(n)]
+        for a in self.lost[n - 1]:
+            lines.append('0x{:X}[{}]\n'.format(a, self.blocks[a][0]))
+            for b in self._indirect([a]):
+                lines.append('  0x{:X}[{}] indirect loss record {}\n'.format(b, self.blocks[b][0], n))
+        return ''.join(lines)
+
+    def _who_points_at(self, args):
+        lo = int(args[0], 0)
+        hi = lo + (int(args[1]) if len(args) > 1 else 1)
+        if hi - lo == 1:
+            lines = ['Searching for pointers to 0x%x\n'%lo]
+        else:
+            lines = ['Searching for pointers pointing in %d bytes from 0x%x\n'%(hi - lo, lo)]
+        for addr, (size, ptrs) in self.blocks.items():
+            for i, p in enumerate(ptrs):
+                if lo <= p < hi:
+                    loc = addr + 8 * i
+                    if p == lo:
+                        lines.append('*0x%x points at 0x%x\n'%(loc, p))
+                    else:
+                        # as valgrind does, relative to the start of the range
+                        lines.append('*0x%x interior points at %d bytes inside 0x%x\n'%(loc, p - lo, lo))
+                    lines.append(" Address 0x%x is %d bytes inside a block of size %d alloc'd\n"%(loc, loc - addr, size))
+                    lines.append(self._trace(addr))
+        return ''.join(lines)
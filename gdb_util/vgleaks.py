@@ -21,25 +21,185 @@
 
 import gdb
 import re
-from gdb_util.leak_dfs import PointerGraph, LoopFindVisitor
-from graph_tool.search import dfs_search, StopSearch
+import time
+from gdb_util.leak_dfs import PointerGraph, LoopFindVisitor, cycle_groups, dfs_search, StopSearch
+from gdb_util import vgparse, vgclient, vgsnapshot
+from functools import partial
 
-# single step until Valgrind reports a leak (sloooowwww)
+# all of our requests to valgrind go through here
+monitor = vgclient.MonitorClient()
+
+# step until Valgrind reports a new leak
 class StepToLeak(gdb.Command):
-    """Step until valgrind reports a leak"""
+    """Step until valgrind reports a leak
+
+    Usage: stepl [--bisect]
+
+    We stop when the number of definitely lost bytes grows beyond what it was
+    when stepl started. Valgrind is asked only for the records that have
+    increased since its last check, which is much cheaper than a full report.
+
+    The check is done every stepl-check-steps statements, or after
+    stepl-check-ms milliseconds of stepping, whichever comes first. If that is
+    more than one statement, we report how many statements the leak could be in.
+
+    With --bisect, the program is restarted and we count statements from the
+    start of main. The stretches between checks double in length each time no
+    leak is found, and once one has leaked we find the statement responsible by
+    binary search, running the program again and replaying the counted number of
+    statements whenever we need to go back. So n statements need O(log n) leak
+    checks instead of n. This needs a program that does the same thing each time
+    it runs, and a target that can restart it: under valgrind, connect with
+    "target extended-remote | vgdb --multi --vargs ..." (gdb's checkpoints would
+    be cheaper, but only exist for native processes, which have no leak_check).
+
+    In functions outside of user code (no debug info, or a name matching
+    stepl-ignore-regex) we "next" instead of "step", so library internals
+    aren't single-stepped.
+    """
+
+    ignoreRegex = None   # for identifying library functions; see stepl-ignore-regex
+    checkSteps = 1       # statements between leak checks; see stepl-check-steps
+    checkMs = 0          # time between leak checks (0 for no limit); see stepl-check-ms
 
     def __init__ (self):
         super (StepToLeak, self).__init__ ("stepl", gdb.COMMAND_RUNNING)
 
-    def invoke(self, arg, from_tty):
-        result = gdb.execute('mo leak full', False, True)
-        while result.find('are definitely lost in loss record') is -1:
+    @staticmethod
+    def _leak_check():
+        """Return the total definitely lost bytes, and the report of what has increased"""
+        result = monitor.execute('leak_check full definite increased')
+        total = vgparse.parse_leak_summary(result).get('definitely lost')
+        return (total.bytes if total else 0), result
+
+    @staticmethod
+    def _in_user_code(frame):
+        if frame.find_sal().symtab is None:
+            return False
+        name = frame.name()
+        return name is None or not re.match(StepToLeak.ignoreRegex, name)
+
+    @staticmethod
+    def _step(count = 1, ms = 0):
+        """Advance by count statements, or until ms milliseconds have passed if nonzero
+
+        Returns the number of statements we managed, and whether the program can go on
+        """
+        deadline = time.monotonic() + ms / 1000.0
+        for n in range(count):
+            if ms and n and time.monotonic() >= deadline:
+                return n, True
+            cmd = 'step' if StepToLeak._in_user_code(gdb.selected_frame()) else 'next'
             try:
-                gdb.execute('step', to_string = True)  # QUIETLY step
+                gdb.execute(cmd, to_string = True)  # QUIETLY step
             except gdb.error:
                 print('error while stepping')  # BOZO handle
+                return n, False
+        return count, True
+
+    @staticmethod
+    def _restart():
+        """Run the program again, stopping at the start of main"""
+        confirm = gdb.parameter('confirm')
+        gdb.execute('set confirm off')
+        try:
+            gdb.execute('start', to_string = True)
+        except gdb.error as e:
+            raise gdb.GdbError('stepl --bisect needs to restart the program, which this target cannot do (%s). '
+                               'Under valgrind, use "target extended-remote | vgdb --multi --vargs ..."'%e)
+        finally:
+            gdb.execute('set confirm %s'%('on' if confirm else 'off'))
+
+    @staticmethod
+    def _replay(count):
+        """Run the program again, and go count statements from the start of main"""
+        StepToLeak._restart()
+        done, more = StepToLeak._step(count)
+        if done != count:
+            raise gdb.GdbError('stepl: the program did not get as far when run again; '
+                               'stepl --bisect needs it to do the same thing every time')
+
+    @staticmethod
+    def _refine(lo, hi, baseline):
+        """Find the first leaking statement, given that statement lo (counting from
+        main) was clean and statement hi leaked
+
+        We are currently at hi. Returns the leak report from the leaking statement.
+        """
+
+        pos = hi        # where we are now
+        result = None
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if mid > pos:
+                StepToLeak._step(mid - pos)
+            else:
+                StepToLeak._replay(mid)
+            pos = mid
+            lost, result = StepToLeak._leak_check()
+            if lost > baseline:
+                hi = mid
+            else:
+                lo = mid
+
+        # finish at the first leaking statement
+        if pos != hi:
+            StepToLeak._step(hi - pos)
+            lost, result = StepToLeak._leak_check()
+        return result
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if any(a != '--bisect' for a in argv):
+            raise gdb.GdbError('usage: stepl [--bisect]')
+        bisect = bool(argv)
+
+        if bisect:
+            StepToLeak._restart()
+            limit = 1
+        elif StepToLeak.checkSteps:
+            limit = StepToLeak.checkSteps
+        else:
+            limit = 1 << 62   # only limited by time (or the end of the program)
+
+        # leaks we already know about don't count
+        baseline, result = StepToLeak._leak_check()
+
+        pos = 0         # statements done, for --bisect counted from main
+        clean = 0       # the last position known not to leak
+        leaked = False
+        while True:
+            done, more = StepToLeak._step(limit, 0 if bisect else StepToLeak.checkMs)
+            pos += done
+            if not more:
+                break    # the program has finished (or we cannot step); nothing to check
+            lost, result = StepToLeak._leak_check()
+            if lost > baseline:
+                leaked = True
                 break
-            result = gdb.execute('mo leak full', False, True)
+            clean = pos
+            if bisect:
+                limit *= 2
+
+        if not leaked and bisect and pos > clean:
+            # the program ended partway through the last stretch; see if it leaked by its last statement
+            StepToLeak._replay(pos)
+            lost, result = StepToLeak._leak_check()
+            leaked = lost > baseline
+
+        if not leaked:
+            if pos > clean:
+                print('stepping stopped %d statements after the last leak check'%(pos - clean))
+            print('no new leak found; last loss report:\n%s'%result)
+            return
+
+        if pos - clean > 1:
+            if bisect:
+                result = StepToLeak._refine(clean, pos, baseline)
+            else:
+                print('definitely lost bytes grew within the last %d statements '
+                      '(stepl --bisect can find which one)'%(pos - clean))
+
         print('loss report:\n%s'%result)
         print('leak first noticed at:\n')
         gdb.execute('bt')
@@ -48,45 +208,131 @@ StepToLeak()
 
 # when you've found a leak this will look for reference loops
 class PrintPtrLoop(gdb.Command):
-    """Find a reference loop in the leak report"""
+    """Find a reference loop in the leak report
+
+    Usage: ppl [--all] [--bulk] [--cycles]
+
+    With --bulk, pointers to all leaked blocks are found with a single heap scan
+    up front, instead of one scan per block as the search proceeds.
+
+    With --all, a loop is searched for through each block of every loss record,
+    sharing what is learned about pointers between searches, and the loops found
+    are reported together at the end, largest first.
+
+    With --cycles, the pointers among all leaked blocks are gathered, and every
+    group of blocks that point to each other in a cycle is reported, largest first.
+
+    Otherwise, a single loop through the first leaked block is reported.
+    """
 
     def __init__ (self):
         super (PrintPtrLoop, self).__init__ ("ppl", gdb.COMMAND_DATA)
 
+    # who_points_at makes valgrind scan the whole heap, so we remember the answers
+    # until the program runs again. Addresses are kept as ints, and only formatted
+    # for display.
+
+    _wpa_cache = {}
+    _traces = vgparse.TraceTable()   # allocation backtraces seen in valgrind's answers
+    pipelineDepth = 1    # who_points_at requests sent together; see ppl-pipeline-depth
+    prefetchGap = 0x1000       # blocks further apart than this are not scanned for together
+    prefetchSpan = 0x100000    # the most address space one bulk who_points_at may cover
+
+    @staticmethod
+    def _clear_cache(event):
+        PrintPtrLoop._wpa_cache.clear()
+
     @staticmethod
     def _get_pointers(block_addr):
         """For a given address, find all pointers to it from other blocks
 
-        Returns a dict of addresses (hex strings) to backtraces and internal
-        pointers, for each allocation
+        Returns a dict of the addresses of the blocks containing the pointers to
+        their allocation backtraces (indices into _traces, or None)
         """
 
-        wpatxt = gdb.execute('monitor who_points_at %s'%block_addr, to_string = True)
+        if block_addr not in PrintPtrLoop._wpa_cache:
+            PrintPtrLoop._request_pointers([block_addr])
+        return PrintPtrLoop._wpa_cache[block_addr]
 
-        addr_re  = re.compile('^ Address (0x[0-9A-Fa-f]+) is ([0-9]+) bytes inside a block.*')
-        trace_re = re.compile('(at|by) 0x[0-9A-Fa-f]+: ')
-        wpait = iter(wpatxt.splitlines())
+    @staticmethod
+    def _request_pointers(addrs):
+        """Ask valgrind about each of the addresses we don't already know, all together"""
+
+        queued = set()
+        for addr in addrs:
+            if addr not in PrintPtrLoop._wpa_cache and addr not in queued:
+                queued.add(addr)
+                monitor.submit('who_points_at %s'%PrintPtrLoop._hex(addr),
+                               partial(PrintPtrLoop._store_pointers, addr))
+        monitor.flush()
+
+    @staticmethod
+    def _store_pointers(block_addr, wpatxt):
         result = {}
-        wpaln = next(wpait, None)
-        while wpaln is not None:
-            m = addr_re.match(wpaln)
-            if m:
-                ptr = m.group(1)
-                ofs = int(m.group(2))
-                # calculate the base of its block
-                base = '0x{:02X}'.format(int(ptr, 0)-ofs)
-                if base == block_addr:
-                    wpaln = next(wpait, None)
+        for ptr in vgparse.parse_who_points_at(wpatxt, PrintPtrLoop._traces):
+            if ptr.block is None:
+                continue   # not in a heap block
+            if ptr.block == block_addr:
+                continue
+            result[ptr.block] = ptr.trace   # TODO also store addresses
+        PrintPtrLoop._wpa_cache[block_addr] = result
+
+    @staticmethod
+    def _prefetch_pointers(blocks):
+        """Find the pointers to all of the given blocks with a few heap scans
+
+        blocks is a dict of block addresses to sizes. Instead of asking
+        valgrind about one block at a time, we ask for every pointer into address
+        ranges spanning several of them, and sort the answers out ourselves.
+        Each range covers blocks close to one another and is at most prefetchSpan
+        bytes long, since valgrind reports every pointer into it, including any
+        from library code and data that happen to lie nearby.
+        """
+
+        blocks = sorted((addr, size) for addr, size in blocks.items() if addr not in PrintPtrLoop._wpa_cache)
+        ranges = []   # lists of (addr, size) of nearby blocks
+        for addr, size in blocks:
+            if ranges:
+                lo = ranges[-1][0][0]
+                last_addr, last_size = ranges[-1][-1]
+                if (addr - (last_addr + last_size) <= PrintPtrLoop.prefetchGap and
+                    addr + size - lo <= PrintPtrLoop.prefetchSpan):
+                    ranges[-1].append((addr, size))
                     continue
-                # suck in the backtrace associated with the allocation for this block
-                trace = ''
-                wpaln = next(wpait, None)
-                while wpaln is not None and trace_re.search(wpaln):
-                    trace += wpaln + '\n'
-                    wpaln = next(wpait, None)
-                result[base] = trace   # TODO also store addresses
-            wpaln = next(wpait, None)
-        return result
+            ranges.append([(addr, size)])
+
+        for rng in ranges:
+            if len(rng) == 1:
+                # just an ordinary query
+                addr = rng[0][0]
+                monitor.submit('who_points_at %s'%PrintPtrLoop._hex(addr),
+                               partial(PrintPtrLoop._store_pointers, addr))
+            else:
+                lo = rng[0][0]
+                hi = max(addr + size for addr, size in rng)
+                monitor.submit('who_points_at 0x{:X} {}'.format(lo, hi - lo),
+                               partial(PrintPtrLoop._store_range_pointers, [addr for addr, size in rng]))
+        monitor.flush()
+
+    @staticmethod
+    def _store_range_pointers(block_addrs, wpatxt):
+        results = {addr: {} for addr in block_addrs}
+        for ptr in vgparse.parse_who_points_at(wpatxt, PrintPtrLoop._traces):
+            if ptr.target is None or ptr.block is None:
+                continue
+            # like a single-block query, we are only interested in pointers to the start of a block
+            if ptr.target in results and ptr.block != ptr.target:
+                results[ptr.target][ptr.block] = ptr.trace
+        PrintPtrLoop._wpa_cache.update(results)
+
+    @staticmethod
+    def _trace_text(trace):
+        # graph properties use -1 for "no trace"
+        return PrintPtrLoop._traces.format(trace) if trace is not None and trace >= 0 else ''
+
+    @staticmethod
+    def _hex(addr):
+        return '0x{:02X}'.format(addr)
 
     # utility functions for the DFS
 
@@ -99,10 +345,13 @@ class PrintPtrLoop(gdb.Command):
     def expand_vertex(g, u):
         addr = g.vaddr_pmap[u]
         ptr_dict = PrintPtrLoop._get_pointers(addr)
-        for ptr in ptr_dict:
+        # the search will visit these next, so ask about several of them at once
+        ahead = [ptr for ptr in ptr_dict if ptr not in g.addr2v][:PrintPtrLoop.pipelineDepth]
+        if len(ahead) > 1:
+            PrintPtrLoop._request_pointers(ahead)
+        for ptr, trace in ptr_dict.items():
             if ptr not in g.addr2v:
-                e = g.create_ptr_edge(ptr, u)
-                g.backtraces[e.target()] = ptr_dict[ptr]
+                g.create_ptr_edge(ptr, u, trace)
             else:
                 # only add the edge
                 g.add_edge(u, g.addr2v[ptr])
@@ -111,18 +360,25 @@ class PrintPtrLoop(gdb.Command):
     # We print out the block addresses and optional the backtraces of the allocation
 
     @staticmethod
-    def report_backedge(g, e, pred):
-        print('Pointer loop detected:')
-        print_backtrace = gdb.parameter('ppl-backtrace')
+    def _loop_path(e, pred):
+        """Return the loop completed by back edge e, as a list of vertex indices
+
+        Consecutive entries are edges of the loop; the first and last are the same vertex.
+        """
 
         # e is the final edge that completes the loop
         # we want to display the previous edges, in order, followed by e
         # the predecessor map gives them to us in reverse
         path = [int(e.target()), int(e.source())]   # reversed path by vertex index
         v = int(e.source())
-        while v is not int(e.target()):
+        while v != int(e.target()):
             v = pred[v]
             path.append(v)
+        return path
+
+    @staticmethod
+    def _print_loop(g, path):
+        print_backtrace = gdb.parameter('ppl-backtrace')
         # now print "path" by edge, reversed, followed by the final edge
         # zip (reversed) path with itself, offset, to get pairs of vertices
         # see "pairwise" recipe in itertools docs
@@ -130,46 +386,289 @@ class PrintPtrLoop(gdb.Command):
         targets = iter(path)
         next(targets, None)     # shift targets by one so edges line up
         for u, v in zip(sources, targets):
-            print('block %s has pointers to block %s'%(g.vaddr_pmap[u], g.vaddr_pmap[v]))
+            print('block %s has pointers to block %s'%(PrintPtrLoop._hex(g.vaddr_pmap[u]),
+                                                       PrintPtrLoop._hex(g.vaddr_pmap[v])))
             if print_backtrace:
-                print(g.backtraces[u])
+                print(PrintPtrLoop._trace_text(g.backtraces[u]))
+
+    @staticmethod
+    def report_backedge(g, e, pred):
+        print('Pointer loop detected:')
+        PrintPtrLoop._print_loop(g, PrintPtrLoop._loop_path(e, pred))
         # terminate loop search
         raise StopSearch()
 
+    @staticmethod
+    def _block_lists(records):
+        """Run block_list for each loss record
+
+        Returns a list of (record number, allocation backtrace, blocks) with the
+        blocks as vgparse.Block records.
+        """
+
+        result = []
+        for rec in records:
+            # block_list shows each block, followed by the indirectly lost blocks it points to
+            bl_rpt = monitor.execute('block_list %d'%rec.number)
+            trace = None
+            blocks = []
+            for item in vgparse.parse_block_list(bl_rpt, PrintPtrLoop._traces):
+                if isinstance(item, vgparse.LossRecord):
+                    trace = item.trace
+                else:
+                    blocks.append(item)
+            result.append((rec.number, trace, blocks))
+        return result
+
+    @staticmethod
+    def _all_leaked_blocks(block_lists):
+        """Return a dict of addresses to sizes for every block in the block lists"""
+
+        return {blk.addr: blk.size for _, _, blocks in block_lists for blk in blocks}
+
+    @staticmethod
+    def search_all(block_lists):
+        """Search for a loop through each block of every loss record, then report them all
+
+        All of the searches share one graph, so each block's pointers are only
+        looked up once.
+        """
+
+        sizes = PrintPtrLoop._all_leaked_blocks(block_lists)
+        # one pass over the heap gets the pointers to everything
+        PrintPtrLoop._prefetch_pointers(sizes)
+
+        g = PointerGraph()
+        pred = g.new_vertex_property('int64_t')
+        loops = {}     # blocks in loop -> (total bytes, loss record, path)
+
+        for number, trace, blocks in block_lists:
+
+            def record_loop(g, e, pred):
+                path = PrintPtrLoop._loop_path(e, pred)
+                members = frozenset(g.vaddr_pmap[v] for v in path)
+                if members not in loops:
+                    loops[members] = (sum(sizes.get(a, 0) for a in members), number, path)
+                # one loop per starting block, as for a single search
+                raise StopSearch()
+
+            for blk in blocks:
+                if blk.indirect_record is not None:
+                    continue   # only reachable through another block of this record
+                if blk.addr not in g.addr2v:
+                    g.create_ptr(blk.addr)
+                g.root = g.addr2v[blk.addr]
+                g.backtraces[g.root] = trace if trace is not None else -1
+                vis = LoopFindVisitor(g, pred, PrintPtrLoop.expand_vertex, record_loop)
+                dfs_search(g, g.root, vis)
+
+        if not loops:
+            print('no loops found')
+            return
+
+        # biggest first
+        print('%d pointer loops found'%len(loops))
+        for total, number, path in sorted(loops.values(), key=lambda lp: -lp[0]):
+            print('Pointer loop of %d blocks, %d bytes, from loss record %d:'%(len(path) - 1, total, number))
+            PrintPtrLoop._print_loop(g, path)
+
+    @staticmethod
+    def report_cycles(blocks):
+        """Find and print every pointer cycle among the given blocks
+
+        blocks is a dict of addresses to sizes. Pointers to all of them
+        are found first, then the cycles are found in a single pass over the graph.
+        """
+
+        PrintPtrLoop._prefetch_pointers(blocks)
+
+        g = PointerGraph()
+        for addr in blocks:
+            g.create_ptr(addr)
+        traces = {}
+        for addr in blocks:
+            for ptr, trace in PrintPtrLoop._get_pointers(addr).items():
+                if ptr in blocks:
+                    # edges go from pointee to pointer, as in the search
+                    g.add_edge(g.addr2v[addr], g.addr2v[ptr])
+                    traces[ptr] = trace
+
+        groups = []
+        for vs in cycle_groups(g):
+            addrs = [g.vaddr_pmap[v] for v in vs]
+            groups.append((sum(blocks[a] for a in addrs), addrs))
+        if not groups:
+            print('no loops found')
+            return
+
+        print_backtrace = gdb.parameter('ppl-backtrace')
+        # biggest first
+        for total, addrs in sorted(groups, key=lambda grp: -grp[0]):
+            print('Pointer cycle of %d blocks, %d bytes:'%(len(addrs), total))
+            for addr in sorted(addrs):
+                print('  block %s (%d bytes)'%(PrintPtrLoop._hex(addr), blocks[addr]))
+                if print_backtrace:
+                    print(PrintPtrLoop._trace_text(traces.get(addr)))
+
     def invoke(self, arg, from_tty):
-        leak_rpt = gdb.execute('monitor leak_check full any', to_string = True)
+        argv = gdb.string_to_argv(arg)
+        flags = ('--all', '--bulk', '--cycles')
+        if any(a not in flags for a in argv):
+            raise gdb.GdbError('usage: ppl [--all] [--bulk] [--cycles]')
+        bulk = '--bulk' in argv
+
+        leak_rpt = monitor.execute('leak_check full any')
+
+        # extract the loss records from the leak report
+        records = [rec for rec in vgparse.parse_leak_check(leak_rpt, PrintPtrLoop._traces)
+                   if rec.kind in ('definitely lost', 'possibly lost')]
+        if not records:
+            print('no loops found')
+            return
 
-        # extract the loss record number from the leak report
-        rx = re.compile('are (definitely|possibly) lost in loss record ([0-9]+) of')
-        m = rx.search(leak_rpt)
-        if not m:
+        if '--cycles' in argv:
+            PrintPtrLoop.report_cycles(PrintPtrLoop._all_leaked_blocks(PrintPtrLoop._block_lists(records)))
+            return
+
+        if '--all' in argv:
+            PrintPtrLoop.search_all(PrintPtrLoop._block_lists(records))
+            return
+
+        if bulk:
+            # build the whole reverse-pointer graph of the leaked blocks up front
+            PrintPtrLoop._prefetch_pointers(PrintPtrLoop._all_leaked_blocks(PrintPtrLoop._block_lists(records)))
+
+        # request block list for the first record
+        bl_rpt = monitor.execute('block_list %d'%records[0].number)
+
+        # get the allocation backtrace for this initial block, and the block itself
+        # (the first entry; the rest are the indirectly lost blocks it points to)
+        backtrace = None
+        root = None
+        for item in vgparse.parse_block_list(bl_rpt, PrintPtrLoop._traces):
+            if isinstance(item, vgparse.LossRecord):
+                backtrace = item.trace
+            elif root is None:
+                root = item.addr
+        if root is None:
             print('no loops found')
             return
 
-        # request block list for that record number
-        blockno = m.group(2)
-        bl_rpt = gdb.execute('monitor block_list %s'%blockno, to_string = True)
-
-        # get the allocation backtrace for this initial block
-        trace_re = re.compile('(at|by) 0x[0-9A-Fa-f]+: ')
-        backtrace = ''
-        for ln in bl_rpt.splitlines():
-            if trace_re.search(ln):
-                backtrace += ln + '\n'
-
-        # extract the first block and call "who_points_at" to get pointers
-        # key part is the single indentation - the first entry:
-        blre = re.compile('=+[0-9]+=+ (0x[0-9A-F]+)\[')
-        m = blre.search(bl_rpt)
-
-        g = PointerGraph(m.group(1))
-        g.backtraces = g.new_vertex_property('string')
-        g.backtraces[g.root] = backtrace
+        g = PointerGraph(root, backtrace)
         pred = g.new_vertex_property('int64_t')
         vis = LoopFindVisitor(g, pred, PrintPtrLoop.expand_vertex, PrintPtrLoop.report_backedge)
         dfs_search(g, g.root, vis)
 
 PrintPtrLoop()
+# any previous answers from valgrind are out of date once the program runs
+gdb.events.cont.connect(PrintPtrLoop._clear_cache)
+
+# save the leaks, and the pointers between the leaked blocks, for later comparison
+class LeakSnapshot(gdb.Command):
+    """Save the current leaks to FILE, for comparison with leak-diff
+
+    Usage: leak-snapshot FILE
+
+    All of the loss records from a full leak check are saved, along with the blocks
+    in each definitely or possibly lost record and the pointers between them. The
+    snapshot can be compared with others later, without the program or valgrind.
+    """
+
+    def __init__ (self):
+        super (LeakSnapshot, self).__init__ ("leak-snapshot", gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 1:
+            raise gdb.GdbError('usage: leak-snapshot FILE')
+
+        snap = vgsnapshot.Snapshot()
+        records = []
+        leak_rpt = monitor.execute('leak_check full any')
+        for rec in vgparse.parse_leak_check(leak_rpt, PrintPtrLoop._traces):
+            snap.add_record(rec, PrintPtrLoop._traces)
+            if rec.kind in ('definitely lost', 'possibly lost'):
+                records.append(rec)
+
+        # an indirectly lost block may be listed under more than one record
+        block_lists = PrintPtrLoop._block_lists(records)
+        sizes = PrintPtrLoop._all_leaked_blocks(block_lists)
+        seen = set()
+        for _, _, blocks in block_lists:
+            for blk in blocks:
+                if blk.addr not in seen:
+                    seen.add(blk.addr)
+                    snap.add_block(blk)
+
+        PrintPtrLoop._prefetch_pointers(sizes)
+        for addr in sizes:
+            for ptr in PrintPtrLoop._get_pointers(addr):
+                if ptr in sizes:
+                    snap.add_edge(ptr, addr)
+
+        try:
+            snap.save(argv[0])
+        except OSError as e:
+            raise gdb.GdbError('leak-snapshot: %s'%e)
+        print('%d loss records, %d blocks and %d pointers saved to %s'%(
+            len(snap.records), len(snap.block_addr), len(snap.edge_src), argv[0]))
+
+LeakSnapshot()
+
+# compare two snapshots
+class LeakDiff(gdb.Command):
+    """Show what has leaked between two snapshots saved by leak-snapshot
+
+    Usage: leak-diff OLD NEW
+
+    Reports the pointer cycles, the loss records that have grown, and the allocation
+    stacks that appear in NEW but not OLD. The snapshots can be from different runs:
+    they are matched by the functions and source locations in their stacks.
+    """
+
+    def __init__ (self):
+        super (LeakDiff, self).__init__ ("leak-diff", gdb.COMMAND_DATA, gdb.COMPLETE_FILENAME)
+
+    def invoke(self, arg, from_tty):
+        argv = gdb.string_to_argv(arg)
+        if len(argv) != 2:
+            raise gdb.GdbError('usage: leak-diff OLD NEW')
+        try:
+            old, new = [vgsnapshot.Snapshot.load(fname) for fname in argv]
+        except (OSError, ValueError) as e:
+            raise gdb.GdbError('leak-diff: %s'%e)
+
+        result = vgsnapshot.diff(old, new)
+        print_backtrace = gdb.parameter('ppl-backtrace')
+        block_traces = new.block_traces()
+
+        def trace_text(idx):
+            return new.traces.format(idx) if idx is not None else ''
+
+        # biggest first
+        print('%d new pointer cycles'%len(result.new_cycles))
+        cycles = [(sum(new.block_size[i] for i in c), c) for c in result.new_cycles]
+        for total, cycle in sorted(cycles, key=lambda cyc: -cyc[0]):
+            print('Pointer cycle of %d blocks, %d bytes:'%(len(cycle), total))
+            for i in sorted(cycle, key=lambda i: new.block_addr[i]):
+                print('  block %s (%d bytes)'%(PrintPtrLoop._hex(new.block_addr[i]), new.block_size[i]))
+                if print_backtrace:
+                    print(trace_text(block_traces[i]))
+
+        print('%d loss records grew'%len(result.grown_records))
+        for prev, rec in result.grown_records:
+            if prev is None:
+                print('%d bytes in %d blocks are %s (new)'%(rec.bytes, rec.blocks, rec.kind))
+            else:
+                print('%d (+%d) bytes in %d (%+d) blocks are %s'%(
+                    rec.bytes, rec.bytes - prev.bytes, rec.blocks, rec.blocks - prev.blocks, rec.kind))
+            print(trace_text(rec.trace))
+
+        print('%d new allocation stacks'%len(result.new_stacks))
+        for idx in result.new_stacks:
+            print(trace_text(idx))
+
+LeakDiff()
 
 # Let users specify the display of tracebacks for allocations in pointer loops
 class PtrLoopBacktrace(gdb.Parameter):
@@ -192,3 +691,117 @@ class PtrLoopBacktrace(gdb.Parameter):
         return svalue
 
 PtrLoopBacktrace()
+
+# functions that stepl steps over rather than into
+class StepLeakIgnoreRegex(gdb.Parameter):
+    """Regex for functions stepl should "next" through rather than "step" through"""
+
+    set_doc = "set this to skip different library namespaces etc."
+    show_doc = "show the regex for functions stepl steps over"
+
+    def __init__(self):
+        super(StepLeakIgnoreRegex, self).__init__("stepl-ignore-regex",
+                                                  gdb.COMMAND_RUNNING,
+                                                  gdb.PARAM_STRING_NOESCAPE)
+        StepToLeak.ignoreRegex = '^(std::|__gnu)'   # default
+
+    def get_set_string(self):
+        StepToLeak.ignoreRegex = self.value
+        return StepToLeak.ignoreRegex
+
+    def get_show_string(self, svalue):
+        return StepToLeak.ignoreRegex
+
+StepLeakIgnoreRegex()
+
+# how often stepl checks for leaks
+class StepLeakCheckSteps(gdb.Parameter):
+    """Number of statements stepl executes between leak checks"""
+
+    set_doc = "set how many statements stepl executes between leak checks (0 for no limit)"
+    show_doc = "show how many statements stepl executes between leak checks"
+
+    def __init__(self):
+        super(StepLeakCheckSteps, self).__init__("stepl-check-steps",
+                                                 gdb.COMMAND_RUNNING,
+                                                 gdb.PARAM_ZUINTEGER)
+        self.value = StepToLeak.checkSteps
+
+    def get_set_string(self):
+        StepToLeak.checkSteps = self.value
+        return str(self.value)
+
+    def get_show_string(self, svalue):
+        return svalue
+
+StepLeakCheckSteps()
+
+class StepLeakCheckMs(gdb.Parameter):
+    """Milliseconds of stepping between stepl's leak checks"""
+
+    set_doc = "set the time in ms stepl steps for between leak checks (0 for no limit)"
+    show_doc = "show the time in ms stepl steps for between leak checks"
+
+    def __init__(self):
+        super(StepLeakCheckMs, self).__init__("stepl-check-ms",
+                                              gdb.COMMAND_RUNNING,
+                                              gdb.PARAM_ZUINTEGER)
+        self.value = StepToLeak.checkMs
+
+    def get_set_string(self):
+        StepToLeak.checkMs = self.value
+        return str(self.value)
+
+    def get_show_string(self, svalue):
+        return svalue
+
+StepLeakCheckMs()
+
+# how many who_points_at requests ppl sends to valgrind at once
+class PtrLoopPipelineDepth(gdb.Parameter):
+    """Number of blocks ppl asks valgrind about at once
+
+    gdb sends monitor commands one at a time, so asking ahead only helps with a
+    transport that can overlap requests; otherwise it just means scanning the heap
+    for blocks the search may never reach. Hence the default of 1.
+    """
+
+    set_doc = "set how many who_points_at requests ppl sends together (0 or 1 for one at a time)"
+    show_doc = "show how many who_points_at requests ppl sends together"
+
+    def __init__(self):
+        super(PtrLoopPipelineDepth, self).__init__("ppl-pipeline-depth",
+                                                   gdb.COMMAND_DATA,
+                                                   gdb.PARAM_ZUINTEGER)
+        self.value = PrintPtrLoop.pipelineDepth
+
+    def get_set_string(self):
+        PrintPtrLoop.pipelineDepth = self.value
+        return str(self.value)
+
+    def get_show_string(self, svalue):
+        return svalue
+
+PtrLoopPipelineDepth()
+
+# report the time taken by each request to valgrind
+class MonitorLogTiming(gdb.Parameter):
+    """Enable logging of the time taken by each valgrind monitor request"""
+
+    set_doc = "True to print the time taken by each monitor command stepl and ppl send to valgrind"
+    show_doc = "Show whether we print the time taken by valgrind monitor commands"
+
+    def __init__(self):
+        super(MonitorLogTiming, self).__init__("vg-log-timing",
+                                               gdb.COMMAND_DATA,
+                                               gdb.PARAM_BOOLEAN)
+        self.value = False
+
+    def get_set_string(self):
+        monitor.log = print if self.value else None
+        return 'on' if self.value else 'off'
+
+    def get_show_string(self, svalue):
+        return svalue
+
+MonitorLogTiming()
@@ -0,0 +1,202 @@
+# Parsing the output of Valgrind's gdbserver monitor commands
+# Copyright (c) 2018 Jeff Trull
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# This module does not use gdb, so it can be used (and tested) on saved transcripts.
+# Each parser takes either a string or an iterable of lines (e.g. an open file) and
+# generates records as it goes, so the input is never copied or split up front.
+# Addresses and sizes are ints, and allocation backtraces are interned in a
+# TraceTable and referred to by index.
+
+import io
+import re
+from collections import namedtuple
+
+# A loss record header from leak_check or block_list. kind is e.g. "definitely lost";
+# the *_delta fields are only present in leak_check's increased/changed modes.
+LossRecord = namedtuple('LossRecord', ['number', 'total', 'kind', 'new',
+                                       'bytes', 'direct_bytes', 'indirect_bytes', 'blocks',
+                                       'bytes_delta', 'blocks_delta', 'trace'])
+
+# The totals for one kind of leak ("definitely lost" etc.) from the LEAK SUMMARY
+# at the end of a leak_check report. As for LossRecord, the deltas are only present
+# in increased/changed mode.
+LeakTotal = namedtuple('LeakTotal', ['bytes', 'blocks', 'bytes_delta', 'blocks_delta'])
+
+# A block listed by block_list, under the loss record number given by record.
+# Indirectly lost blocks reached from the record's blocks are listed too, with
+# indirect_record giving the loss record they belong to (otherwise None).
+Block = namedtuple('Block', ['addr', 'size', 'record', 'indirect_record'])
+
+# A pointer found by who_points_at. block and size describe the heap block containing
+# it, and are None if the pointer is somewhere else (a stack, a global...)
+Pointer = namedtuple('Pointer', ['location', 'target', 'block', 'size', 'trace'])
+
+class TraceTable:
+    """A deduplicated table of allocation backtraces
+
+    A backtrace is a tuple of (pc, function, location) frames. Identical frames and
+    traces are stored only once, and traces are referred to by their index here.
+    """
+
+    def __init__(self):
+        self._frames = {}
+        self._index = {}
+        self.traces = []
+
+    def frame(self, pc, function, location):
+        key = (pc, function, location)
+        return self._frames.setdefault(key, key)
+
+    def intern(self, frames):
+        """Return the index of a backtrace, adding it if necessary"""
+        frames = tuple(frames)
+        idx = self._index.get(frames)
+        if idx is None:
+            idx = len(self.traces)
+            self._index[frames] = idx
+            self.traces.append(frames)
+        return idx
+
+    def __getitem__(self, idx):
+        return self.traces[idx]
+
+    def __len__(self):
+        return len(self.traces)
+
+    def format(self, idx):
+        """Return a backtrace in Valgrind's format, one frame per line"""
+        lines = []
+        for n, (pc, function, location) in enumerate(self.traces[idx]):
+            lines.append('   %s 0x%X: %s (%s)\n'%('at' if n == 0 else 'by', pc, function, location))
+        return ''.join(lines)
+
+_prefix_re = re.compile(r'^==[0-9]+==')   # present in log output, absent in monitor replies
+_frame_re  = re.compile(r'^\s+(?:at|by) (0x[0-9A-Fa-f]+): (.*?)(?: \(((?:in )?[^()]*)\))?$')
+
+_num = r'([0-9,]+)'
+_delta = r'(?: \(([+-][0-9,]+)\))?'
+_loss_re = re.compile(r'^\s*' + _num + _delta +
+                      r'(?: \(' + _num + _delta + ' direct, ' + _num + _delta + r' indirect\))?' +
+                      ' bytes in ' + _num + _delta + ' blocks are ' +
+                      '(definitely lost|indirectly lost|possibly lost|still reachable)' +
+                      ' in (new )?loss record ' + _num + ' of ' + _num)
+_summary_re = re.compile(r'^\s*(definitely lost|indirectly lost|possibly lost|still reachable|suppressed): ' +
+                         _num + _delta + ' bytes in ' + _num + _delta + ' blocks')
+_block_re = re.compile(r'^ *(0x[0-9A-Fa-f]+)\[([0-9]+)\](?: indirect loss record ([0-9]+))?')
+_points_re = re.compile(r'^\s*\*(0x[0-9A-Fa-f]+) (?:points at (0x[0-9A-Fa-f]+)|interior points at ([0-9]+) bytes inside (0x[0-9A-Fa-f]+))')
+_address_re = re.compile(r'^\s*Address (0x[0-9A-Fa-f]+) is ([0-9,]+) bytes inside a block of size ([0-9,]+)')
+
+def _int(s):
+    return int(s.replace(',', '')) if s is not None else None
+
+def _lines(text):
+    if isinstance(text, str):
+        text = io.StringIO(text)
+    for ln in text:
+        yield _prefix_re.sub('', ln.rstrip('\n'), count=1)
+
+def _with_traces(lines, traces):
+    """Generate (line, trace index) pairs, where trace is the backtrace following the line
+
+    Lines that are part of a backtrace are consumed here. trace is None if no
+    backtrace follows the line.
+    """
+
+    pending = None
+    frames = []
+    for ln in lines:
+        m = _frame_re.match(ln)
+        if m and pending is not None:
+            frames.append(traces.frame(int(m.group(1), 16), m.group(2), m.group(3)))
+            continue
+        if pending is not None:
+            yield pending, (traces.intern(frames) if frames else None)
+        pending = ln
+        frames = []
+    if pending is not None:
+        yield pending, (traces.intern(frames) if frames else None)
+
+def _loss_record(m, trace):
+    return LossRecord(number = _int(m.group(11)), total = _int(m.group(12)),
+                      kind = m.group(9), new = m.group(10) is not None,
+                      bytes = _int(m.group(1)), direct_bytes = _int(m.group(3)),
+                      indirect_bytes = _int(m.group(5)), blocks = _int(m.group(7)),
+                      bytes_delta = _int(m.group(2)), blocks_delta = _int(m.group(8)),
+                      trace = trace)
+
+def parse_leak_check(text, traces):
+    """Generate a LossRecord for each loss record in the output of leak_check"""
+
+    for ln, trace in _with_traces(_lines(text), traces):
+        m = _loss_re.match(ln)
+        if m:
+            yield _loss_record(m, trace)
+
+def parse_leak_summary(text):
+    """Return a dict of leak kinds to LeakTotals, from the summary at the end of leak_check"""
+
+    totals = {}
+    for ln in _lines(text):
+        m = _summary_re.match(ln)
+        if m:
+            totals[m.group(1)] = LeakTotal(bytes = _int(m.group(2)), blocks = _int(m.group(4)),
+                                           bytes_delta = _int(m.group(3)), blocks_delta = _int(m.group(5)))
+    return totals
+
+def parse_block_list(text, traces):
+    """Generate LossRecords and the Blocks belonging to each, from the output of block_list"""
+
+    record = None
+    for ln, trace in _with_traces(_lines(text), traces):
+        m = _loss_re.match(ln)
+        if m:
+            rec = _loss_record(m, trace)
+            record = rec.number
+            yield rec
+            continue
+        m = _block_re.match(ln)
+        if m:
+            yield Block(addr = int(m.group(1), 16), size = int(m.group(2)),
+                        record = record, indirect_record = _int(m.group(3)))
+
+def parse_who_points_at(text, traces):
+    """Generate a Pointer for each pointer reported by who_points_at"""
+
+    pending = None    # (location, target) of a pointer whose description may follow
+    for ln, trace in _with_traces(_lines(text), traces):
+        m = _points_re.match(ln)
+        if m:
+            if pending is not None:
+                yield Pointer(pending[0], pending[1], None, None, None)
+            if m.group(2):
+                target = int(m.group(2), 16)
+            else:
+                target = int(m.group(4), 16) + int(m.group(3))
+            pending = (int(m.group(1), 16), target)
+            continue
+        m = _address_re.match(ln)
+        if m:
+            location = int(m.group(1), 16)
+            target = pending[1] if pending is not None and pending[0] == location else None
+            yield Pointer(location, target, location - _int(m.group(2)), _int(m.group(3)), trace)
+            pending = None
+    if pending is not None:
+        yield Pointer(pending[0], pending[1], None, None, None)
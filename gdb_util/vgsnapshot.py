@@ -0,0 +1,170 @@
+# Saving parsed Valgrind leak reports to disk, and comparing them
+# Copyright (c) 2018 Jeff Trull
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Like vgparse, this module does not use gdb, so snapshots taken in one session
+# can be compared anywhere.
+#
+# A snapshot file is the magic line below followed by a zlib stream holding the
+# length of a JSON header, the header, and then the raw contents of each column
+# array in the order the header lists them. The header has the loss records and
+# stack traces; the columns hold the (potentially very many) blocks and pointers.
+
+import json
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+
+from gdb_util import vgparse
+from gdb_util.leak_dfs import PointerGraph, cycle_groups
+
+_MAGIC = b'VGSNAP1\n'
+_COLUMNS = ('block_addr', 'block_size', 'block_record', 'block_indirect', 'edge_src', 'edge_dst')
+
+class Snapshot:
+    """Leaked blocks, the loss records they belong to, and the pointers between them
+
+    Blocks are kept column-wise: the address, size, loss record and indirect
+    loss record (-1 if none) of block i are block_addr[i], block_size[i] and so on.
+    edge_src[j] has a pointer to edge_dst[j]. Loss record traces are indices
+    into traces.
+    """
+
+    def __init__(self):
+        self.traces = vgparse.TraceTable()
+        self.records = []
+        self.block_addr = array('Q')
+        self.block_size = array('Q')
+        self.block_record = array('q')
+        self.block_indirect = array('q')
+        self.edge_src = array('Q')
+        self.edge_dst = array('Q')
+
+    def add_record(self, rec, traces):
+        """Add a LossRecord, whose trace is an index into traces"""
+        if rec.trace is not None:
+            rec = rec._replace(trace = self.traces.intern(traces[rec.trace]))
+        self.records.append(rec)
+
+    def add_block(self, blk):
+        self.block_addr.append(blk.addr)
+        self.block_size.append(blk.size)
+        self.block_record.append(blk.record if blk.record is not None else -1)
+        self.block_indirect.append(blk.indirect_record if blk.indirect_record is not None else -1)
+
+    def add_edge(self, src, dst):
+        self.edge_src.append(src)
+        self.edge_dst.append(dst)
+
+    def save(self, fname):
+        header = {'byteorder': sys.byteorder,
+                  'records': [list(rec) for rec in self.records],
+                  'traces': [[list(frame) for frame in trace] for trace in self.traces.traces],
+                  'columns': [[name, getattr(self, name).typecode, len(getattr(self, name))]
+                              for name in _COLUMNS]}
+        body = json.dumps(header, separators = (',', ':')).encode('utf-8')
+        packer = zlib.compressobj()
+        with open(fname, 'wb') as out:
+            out.write(_MAGIC)
+            out.write(packer.compress(struct.pack('<Q', len(body)) + body))
+            for name in _COLUMNS:
+                out.write(packer.compress(getattr(self, name).tobytes()))
+            out.write(packer.flush())
+
+    @staticmethod
+    def load(fname):
+        with open(fname, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                raise ValueError('%s is not a leak snapshot'%fname)
+            data = memoryview(zlib.decompress(f.read()))
+        hlen, = struct.unpack_from('<Q', data)
+        header = json.loads(bytes(data[8:8 + hlen]).decode('utf-8'))
+
+        snap = Snapshot()
+        for trace in header['traces']:
+            snap.traces.intern(snap.traces.frame(*frame) for frame in trace)
+        snap.records = [vgparse.LossRecord(*rec) for rec in header['records']]
+        pos = 8 + hlen
+        for name, typecode, count in header['columns']:
+            col = array(typecode)
+            nbytes = col.itemsize * count
+            col.frombytes(data[pos:pos + nbytes])
+            if header['byteorder'] != sys.byteorder:
+                col.byteswap()
+            setattr(snap, name, col)
+            pos += nbytes
+        return snap
+
+    def block_traces(self):
+        """Return the trace of the loss record each block belongs to (indirectly, if so)"""
+        by_number = {rec.number: rec.trace for rec in self.records}
+        return [by_number.get(ind if ind >= 0 else rec)
+                for rec, ind in zip(self.block_record, self.block_indirect)]
+
+    def cycles(self):
+        """Return the index lists of the blocks in each pointer cycle"""
+        g = PointerGraph()
+        for addr in self.block_addr:
+            if addr not in g.addr2v:
+                g.create_ptr(addr)
+        for src, dst in zip(self.edge_src, self.edge_dst):
+            if src in g.addr2v and dst in g.addr2v:
+                g.add_edge(g.addr2v[dst], g.addr2v[src])
+        index = {addr: i for i, addr in enumerate(self.block_addr)}
+        return [[index[g.vaddr_pmap[v]] for v in vs] for vs in cycle_groups(g)]
+
+# Addresses (even of code) differ from run to run, so things are matched between
+# snapshots by the functions and source locations in their stack traces.
+
+def trace_key(traces, idx):
+    return tuple((function, location) for _, function, location in traces[idx]) if idx is not None else ()
+
+# a loss record in the new snapshot that has grown, along with its old counterpart (if any)
+GrownRecord = namedtuple('GrownRecord', ['old', 'new'])
+
+# the result of a comparison. new_cycles are lists of block indices in the new
+# snapshot; new_stacks are trace indices in the new snapshot
+SnapshotDiff = namedtuple('SnapshotDiff', ['new_cycles', 'grown_records', 'new_stacks'])
+
+def diff(old, new):
+    """Compare two Snapshots, finding what has been leaked since the old one"""
+
+    def cycle_key(snap, block_traces, cycle):
+        return tuple(sorted(trace_key(snap.traces, block_traces[i]) for i in cycle))
+
+    old_traces = old.block_traces()
+    old_cycles = set(cycle_key(old, old_traces, c) for c in old.cycles())
+    new_traces = new.block_traces()
+    new_cycles = [c for c in new.cycles() if cycle_key(new, new_traces, c) not in old_cycles]
+
+    # records are matched by kind as well as trace
+    old_records = {(rec.kind, trace_key(old.traces, rec.trace)): rec for rec in old.records}
+    grown = []
+    for rec in new.records:
+        prev = old_records.get((rec.kind, trace_key(new.traces, rec.trace)))
+        if prev is None or rec.bytes > prev.bytes:
+            grown.append(GrownRecord(prev, rec))
+
+    old_stacks = set(trace_key(old.traces, idx) for idx in range(len(old.traces)))
+    new_stacks = [idx for idx in range(len(new.traces)) if trace_key(new.traces, idx) not in old_stacks]
+
+    return SnapshotDiff(new_cycles, grown, new_stacks)
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+# Compare the built-in pointer graph with graph_tool on a synthetic heap
+#
+# usage: python ptrgraph_bench.py [--blocks N] [--edges M] [--seed S]
+#
+# The heap is N blocks with M random pointers between them, plus a ring through
+# every 100th block so there is always a loop to find. For each backend we time
+# building the graph, a loop search from the first block (as ppl does), and
+# finding every strongly connected component (as ppl --cycles does).
+# graph_tool is skipped if it is not installed.
+
+import random
+import time
+from argparse import ArgumentParser
+
+from gdb_util import ptrgraph
+
+def synthetic_heap(nblocks, nedges, seed):
+    rng = random.Random(seed)
+    edges = [(rng.randrange(nblocks), rng.randrange(nblocks)) for _ in range(nedges)]
+    ring = list(range(0, nblocks, 100))
+    edges.extend(zip(ring, ring[1:] + ring[:1]))
+    return [(u, v) for u, v in edges if u != v]
+
+def run(name, Graph, DFSVisitor, StopSearch, dfs_search, label_components, nblocks, edges):
+    class LoopFinder(DFSVisitor):
+        def __init__(self, root):
+            super(LoopFinder, self).__init__()
+            self.root = root
+            self.found = False
+
+        def back_edge(self, e):
+            if e.target() == self.root:
+                self.found = True
+                raise StopSearch()
+
+    class Counter(DFSVisitor):
+        def __init__(self):
+            super(Counter, self).__init__()
+            self.discovered = 0
+
+        def discover_vertex(self, u):
+            self.discovered += 1
+
+    start = time.perf_counter()
+    g = Graph()
+    for _ in range(nblocks):
+        g.add_vertex()
+    for u, v in edges:
+        g.add_edge(u, v)
+    built = time.perf_counter()
+
+    root = g.vertex(0) if hasattr(g, 'vertex') else 0
+    finder = LoopFinder(root)
+    dfs_search(g, root, finder)
+    searched = time.perf_counter()
+
+    counter = Counter()
+    dfs_search(g, root, counter)
+    walked = time.perf_counter()
+
+    comp, hist = label_components(g, directed=True)
+    cyclic = sum(1 for h in hist if h > 1)
+    labelled = time.perf_counter()
+
+    print('%-10s build %7.2fs  loop search %7.2fs (found: %s)  full dfs %7.2fs (%d blocks)  components %7.2fs (%d cyclic)'%(
+        name, built - start, searched - built, finder.found,
+        walked - searched, counter.discovered, labelled - walked, cyclic))
+
+arg_parser = ArgumentParser()
+arg_parser.add_argument('--blocks', type=int, default=250000)
+arg_parser.add_argument('--edges', type=int, default=1000000)
+arg_parser.add_argument('--seed', type=int, default=1)
+args = arg_parser.parse_args()
+
+edges = synthetic_heap(args.blocks, args.edges, args.seed)
+print('%d blocks, %d pointers'%(args.blocks, len(edges)))
+
+run('builtin', ptrgraph.Graph, ptrgraph.DFSVisitor, ptrgraph.StopSearch,
+    ptrgraph.dfs_search, ptrgraph.label_components, args.blocks, edges)
+
+try:
+    start = time.perf_counter()
+    from graph_tool import Graph
+    from graph_tool.search import DFSVisitor, StopSearch, dfs_search
+    from graph_tool.topology import label_components
+    print('graph_tool import took %.2fs'%(time.perf_counter() - start))
+except ImportError:
+    print('graph_tool not installed, skipping')
+else:
+    run('graph_tool', Graph, DFSVisitor, StopSearch, dfs_search, label_components, args.blocks, edges)
@@ -0,0 +1,90 @@
+# Tests for the valgrind monitor client, run against the fake gdbserver
+# Copyright (c) 2018 Jeff Trull
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import unittest
+
+from gdb_util import vgclient, vgparse
+
+# a loop of three blocks, plus a separately leaked pair pointing at each other,
+# and a block pointing into the middle of one of them
+BLOCKS = {0x1000: (16, [0x2000]),
+          0x2000: (32, [0x3000, 0x7000]),
+          0x3000: (16, [0x1000]),
+          0x5000: (16, [0x6000]),
+          0x6000: (16, [0x5000]),
+          0x7000: (16, [0x5008])}
+LOST = [[0x1000], [0x5000]]
+
+class TestFakeVgdb(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = vgclient.FakeVgdb(BLOCKS, lost = LOST)
+        self.client = vgclient.MonitorClient(self.fake)
+        self.traces = vgparse.TraceTable()
+
+    def test_leak_check(self):
+        text = self.client.execute('leak_check full definite increased')
+        records = list(vgparse.parse_leak_check(text, self.traces))
+        self.assertEqual([(r.number, r.bytes, r.direct_bytes, r.indirect_bytes) for r in records],
+                         [(1, 80, 16, 64), (2, 32, 16, 16)])
+        totals = vgparse.parse_leak_summary(text)
+        self.assertEqual(totals['definitely lost'].bytes, 32)
+        self.assertEqual(totals['indirectly lost'].blocks, 4)
+
+    def test_block_list(self):
+        items = list(vgparse.parse_block_list(self.client.execute('block_list 1'), self.traces))
+        self.assertEqual([(b.addr, b.indirect_record) for b in items[1:]],
+                         [(0x1000, None), (0x2000, 1), (0x3000, 1), (0x7000, 1)])
+
+    def test_who_points_at(self):
+        ptrs = list(vgparse.parse_who_points_at(self.client.execute('who_points_at 0x1000'), self.traces))
+        self.assertEqual([(p.location, p.target, p.block) for p in ptrs], [(0x3000, 0x1000, 0x3000)])
+
+    def test_who_points_at_range(self):
+        # pointers anywhere but the start of the range are reported as interior pointers
+        text = self.client.execute('who_points_at 0x1000 20496')
+        self.assertIn('interior points at', text)
+        ptrs = vgparse.parse_who_points_at(text, self.traces)
+        self.assertEqual(sorted((p.block, p.target) for p in ptrs),
+                         [(0x1000, 0x2000), (0x2000, 0x3000), (0x3000, 0x1000),
+                          (0x5000, 0x6000), (0x6000, 0x5000), (0x7000, 0x5008)])
+
+    def test_batch(self):
+        results = []
+        for addr in (0x1000, 0x2000, 0x5000):
+            self.client.submit('who_points_at 0x%x'%addr, results.append)
+        self.assertEqual(self.client.pending(), 3)
+        self.assertEqual(self.fake.commands, [])   # nothing is sent until flushed
+        self.client.flush()
+        self.assertEqual(self.client.pending(), 0)
+        self.assertEqual(self.fake.commands, ['who_points_at 0x1000', 'who_points_at 0x2000',
+                                              'who_points_at 0x5000'])
+        # callbacks are called in order
+        self.assertEqual([r.splitlines()[0] for r in results],
+                         ['Searching for pointers to 0x1000', 'Searching for pointers to 0x2000',
+                          'Searching for pointers to 0x5000'])
+        self.assertEqual([t.command for t in self.client.timings], self.fake.commands)
+
+    def test_unknown_command(self):
+        self.assertIn('not recognised', self.client.execute('v.info all_errors'))
+
+if __name__ == '__main__':
+    unittest.main()
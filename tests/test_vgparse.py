@@ -0,0 +1,174 @@
+# Tests for parsing Valgrind monitor command output, using recorded transcripts
+# Copyright (c) 2018 Jeff Trull
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# vgparse doesn't need gdb, so these run with plain Python:
+#   python -m unittest discover tests
+
+import io
+import unittest
+
+from gdb_util import vgparse
+
+# "monitor leak_check full definite increased", as it appears in a valgrind log
+LEAK_CHECK = """\
+==4321== 24 (+24) bytes in 1 (+1) blocks are definitely lost in new loss record 1 of 3
+==4321==    at 0x4C2FB0F: malloc (in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so)
+==4321==    by 0x108745: make_node (list.c:10)
+==4321==    by 0x1087A2: main (list.c:31)
+==4321==
+==4321== 96 (+48) (24 (+0) direct, 72 (+48) indirect) bytes in 1 (+0) blocks are definitely lost in loss record 3 of 3
+==4321==    at 0x4C2FB0F: malloc (in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so)
+==4321==    by 0x108745: make_node (list.c:10)
+==4321==    by 0x10878C: make_list (list.c:18)
+==4321==    by 0x1087B1: main (list.c:32)
+==4321==
+==4321== LEAK SUMMARY:
+==4321==    definitely lost: 48 (+24) bytes in 2 (+1) blocks
+==4321==    indirectly lost: 72 (+48) bytes in 3 (+2) blocks
+==4321==      possibly lost: 0 (+0) bytes in 0 (+0) blocks
+==4321==    still reachable: 1,024 (+0) bytes in 1 (+0) blocks
+==4321==         suppressed: 0 (+0) bytes in 0 (+0) blocks
+==4321==
+"""
+
+# "monitor block_list 3", as returned to gdb (no ==PID== prefix)
+BLOCK_LIST = """\
+96 (24 direct, 72 indirect) bytes in 1 blocks are definitely lost in loss record 3 of 3
+   at 0x4C2FB0F: malloc (in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so)
+   by 0x108745: make_node (list.c:10)
+   by 0x10878C: make_list (list.c:18)
+   by 0x1087B1: main (list.c:32)
+0x51F8040[24]
+  0x51F80A0[24] indirect loss record 2
+   0x51F8100[24] indirect loss record 2
+    0x51F8160[24] indirect loss record 2
+"""
+
+# "monitor who_points_at 0x51f8040", with pointers from the heap (one far enough
+# into its block that the offset has a thousands separator), an interior pointer,
+# and pointers from local and global variables
+WHO_POINTS_AT = """\
+==4321== Searching for pointers to 0x51f8040
+==4321== *0x51f80b0 points at 0x51f8040
+==4321==  Address 0x51f80b0 is 16 bytes inside a block of size 24 alloc'd
+==4321==    at 0x4C2FB0F: malloc (in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so)
+==4321==    by 0x108745: make_node (list.c:10)
+==4321==    by 0x10878C: make_list (list.c:18)
+==4321== *0x1ffefffd28 points at 0x51f8040
+==4321==  Location 0x1ffefffd28 is 0 bytes inside local var "head"
+==4321==  declared at list.c:28, in frame #0 of thread 1
+==4321== *0x51f8170 interior points at 8 bytes inside 0x51f8040
+==4321==  Address 0x51f8170 is 16 bytes inside a block of size 24 alloc'd
+==4321==    at 0x4C2FB0F: malloc (in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so)
+==4321==    by 0x108745: make_node (list.c:10)
+==4321==    by 0x10878C: make_list (list.c:18)
+==4321== *0x309008 points at 0x51f8040
+==4321==  Location 0x309008 is 0 bytes inside global var "list_head"
+==4321==  declared at list.c:5
+==4321== *0x51fa448 points at 0x51f8040
+==4321==  Address 0x51fa448 is 1,032 bytes inside a block of size 2,048 alloc'd
+==4321==    at 0x4C2FB0F: malloc (in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so)
+==4321==    by 0x1087C4: make_table (list.c:40)
+"""
+
+class TestLeakCheck(unittest.TestCase):
+
+    def test_records(self):
+        traces = vgparse.TraceTable()
+        records = list(vgparse.parse_leak_check(LEAK_CHECK, traces))
+        self.assertEqual(len(records), 2)
+
+        first, second = records
+        self.assertEqual((first.number, first.total, first.kind, first.new), (1, 3, 'definitely lost', True))
+        self.assertEqual((first.bytes, first.blocks), (24, 1))
+        self.assertEqual((first.bytes_delta, first.blocks_delta), (24, 1))
+        self.assertIsNone(first.direct_bytes)
+        self.assertIsNone(first.indirect_bytes)
+
+        self.assertEqual((second.number, second.new), (3, False))
+        self.assertEqual((second.bytes, second.direct_bytes, second.indirect_bytes), (96, 24, 72))
+        self.assertEqual((second.bytes_delta, second.blocks_delta), (48, 0))
+
+        self.assertEqual(traces[first.trace][1], (0x108745, 'make_node', 'list.c:10'))
+        self.assertEqual(len(traces[second.trace]), 4)
+        self.assertEqual(traces[second.trace][0][2], 'in /usr/lib/valgrind/vgpreload_memcheck-amd64-linux.so')
+        # the malloc frame is shared between the two traces
+        self.assertIs(traces[first.trace][0], traces[second.trace][0])
+
+    def test_summary(self):
+        totals = vgparse.parse_leak_summary(LEAK_CHECK)
+        self.assertEqual(totals['definitely lost'], vgparse.LeakTotal(48, 2, 24, 1))
+        self.assertEqual(totals['indirectly lost'], vgparse.LeakTotal(72, 3, 48, 2))
+        self.assertEqual(totals['still reachable'], vgparse.LeakTotal(1024, 1, 0, 0))
+        self.assertEqual(len(totals), 5)
+
+    def test_lines(self):
+        # an open file works as well as a string
+        traces = vgparse.TraceTable()
+        records = list(vgparse.parse_leak_check(io.StringIO(LEAK_CHECK), traces))
+        self.assertEqual([r.number for r in records], [1, 3])
+
+class TestBlockList(unittest.TestCase):
+
+    def test_blocks(self):
+        traces = vgparse.TraceTable()
+        items = list(vgparse.parse_block_list(BLOCK_LIST, traces))
+        record = items[0]
+        self.assertIsInstance(record, vgparse.LossRecord)
+        self.assertEqual((record.number, record.bytes, record.direct_bytes, record.indirect_bytes),
+                         (3, 96, 24, 72))
+        self.assertIsNone(record.bytes_delta)
+        self.assertEqual(traces[record.trace][-1], (0x1087B1, 'main', 'list.c:32'))
+
+        self.assertEqual(items[1:], [vgparse.Block(0x51F8040, 24, 3, None),
+                                     vgparse.Block(0x51F80A0, 24, 3, 2),
+                                     vgparse.Block(0x51F8100, 24, 3, 2),
+                                     vgparse.Block(0x51F8160, 24, 3, 2)])
+
+class TestWhoPointsAt(unittest.TestCase):
+
+    def test_pointers(self):
+        traces = vgparse.TraceTable()
+        ptrs = list(vgparse.parse_who_points_at(WHO_POINTS_AT, traces))
+        self.assertEqual([(p.location, p.target, p.block, p.size) for p in ptrs],
+                         [(0x51f80b0, 0x51f8040, 0x51f80a0, 24),
+                          (0x1ffefffd28, 0x51f8040, None, None),
+                          (0x51f8170, 0x51f8048, 0x51f8160, 24),
+                          (0x309008, 0x51f8040, None, None),
+                          (0x51fa448, 0x51f8040, 0x51fa040, 2048)])
+
+        # both heap blocks were allocated from the same place
+        self.assertEqual(ptrs[0].trace, ptrs[2].trace)
+        self.assertEqual(traces[ptrs[0].trace][2], (0x10878C, 'make_list', 'list.c:18'))
+        self.assertIsNone(ptrs[1].trace)
+        self.assertIsNone(ptrs[3].trace)
+
+    def test_no_prefix(self):
+        # monitor replies come without the ==PID== prefix
+        plain = ''.join(ln.split(' ', 1)[1] for ln in WHO_POINTS_AT.splitlines(True))
+        traces = vgparse.TraceTable()
+        self.assertEqual([(p.location, p.block) for p in vgparse.parse_who_points_at(plain, traces)],
+                         [(0x51f80b0, 0x51f80a0), (0x1ffefffd28, None),
+                          (0x51f8170, 0x51f8160), (0x309008, None),
+                          (0x51fa448, 0x51fa040)])
+
+if __name__ == '__main__':
+    unittest.main()